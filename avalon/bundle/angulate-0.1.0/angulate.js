@@ -46,21 +46,82 @@
     return attr;
   }
 
+  function parse(expression) {
+    return angular.injector(['ng']).get('$parse')(expression);
+  }
+
   function watch(scope, attr) {
-    var $parse = angular.injector(['ng']).get('$parse');
-    return angular.isFunction($parse(attr)(scope)) ? attr + '(this)' : attr;
+    return angular.isFunction(parse(attr)(scope)) ? attr + '(this)' : attr;
+  }
+
+  var uid = 0;
+
+  function hidden(obj, name, value) {
+    if (Object.defineProperty) {
+      Object.defineProperty(obj, name, {
+        value: value, writable: true, configurable: true, enumerable: false
+      });
+    }
+    else {
+      obj[name] = value;
+    }
+  }
+
+  function version(value) {
+    // Values maintained by avalon carry a `$$version` bumped on each change
+    if (!angular.isObject(value) || value.$$version === undefined) {
+      return undefined;
+    }
+    if (value.$$uid === undefined) hidden(value, '$$uid', ++uid);
+    return value.$$uid + ':' + value.$$version;
+  }
+
+  function versionWatch(scope, expression, listener, deep) {
+    // Watch values by version when they have one, other objects by deep
+    // equality and the rest by identity. Deep equality can be forced with
+    // `deep`. The watch itself returns a change counter, so Angular only
+    // ever compares numbers.
+    var get = angular.isFunction(expression) ? expression : parse(expression);
+    var changes = 0, initial = true, last, lastVersion, value, previous;
+    var _$watch = scope.$watch.$$original || scope.$watch;
+
+    function changed(value) {
+      var v = deep ? undefined : version(value);
+      if (initial) return true;
+      if (v !== undefined) return v !== lastVersion;
+      if (angular.isObject(value)) return !angular.equals(value, last);
+      return value !== last && !(value !== value && last !== last);
+    }
+
+    return _$watch.call(scope, function versionWatchValue(s) {
+      value = get(s);
+      if (changed(value)) {
+        previous = last;
+        lastVersion = deep ? undefined : version(value);
+        last = angular.isObject(value) && lastVersion === undefined ?
+          angular.copy(value) : value;
+        initial = false;
+        changes++;
+      }
+      return changes;
+    }, function versionWatchListener(n, o, s) {
+      listener(value, n === o ? value : previous, s);
+    });
   }
 
-  function equalityScope(scope) {
-    // Patch $watch and $watchCollection to use object equality
-    var _$watch = scope.$watch;
+  function versionScope(scope) {
+    // Patch $watch and $watchCollection to detect changes by version, with
+    // object equality only when asked for
+    var _$watch = scope.$watch.$$original || scope.$watch;
 
-    scope.$watch = function $watch(watch, listener) {
-      return _$watch.apply(this, [watch, listener, true]);
+    scope.$watch = function $watch(watch, listener, objectEquality) {
+      if (!listener) return _$watch.apply(this, arguments);
+      return versionWatch(this, watch, listener, objectEquality);
     };
+    scope.$watch.$$original = _$watch;
 
     scope.$watchCollection = function $watchCollection(watch, listener) {
-      return _$watch.apply(this, [watch, listener, true]);
+      return versionWatch(this, watch, listener);
     };
 
     return scope;
@@ -116,12 +177,12 @@
 
         // Create repeat element after this element
         repeat = forkElement(element, 'ng-repeat', repeat,
-          equalityScope(scope.$parent.$new()));
+          versionScope(scope.$parent.$new()));
 
         element.after(repeat.element);
 
         // Watch changes and adjust view depending bind data type
-        scope.$watch(bindName, function bindWatch(v) {
+        versionWatch(scope, bindName, function bindWatch(v) {
           if (element.attr('leaf')) {
             element.text(v == undefined ? '' : v);
             repeat.scope[bind] = null;
@@ -147,7 +208,7 @@
               if (angular.isObject(v)) angular.extend(scope, v);
             }
           }
-        }, true);
+        }, attrs.deep !== undefined);
 
         // Extend repeat scope binding
         if (repeatScopeValue) {
@@ -231,14 +292,14 @@
         element.remove();
         marker.after(element);
 
-        scope.$watch(conditionName, function ifWatch(v) {
+        versionWatch(scope, conditionName, function ifWatch(v) {
           if (negate ? !v : v) {
             enter($animate, element, marker);
           }
           else {
             leave($animate, element);
           }
-        }, true);
+        }, attrs.deep !== undefined);
       }
     }
   }
@@ -8,16 +8,25 @@
   'use strict';
   var VERSION = [0, 0, 1];
   var MAX_ID = 4294967295;
+  var BACKOFF = 500;  // ms
+  var MAX_BACKOFF = 30000;  // ms
 
   var avalon = globals.avalon = {
     session : {__getattr__: function() { return null; }},
-    version: VERSION
+    version: VERSION,
+    metrics: {updates: 0, rollbacks: 0, digests: 0},
+    // Milliseconds between digests of incoming changes, null to digest
+    // once per animation frame
+    digestInterval: null
   };
   var rpc = {
     _id: 0,
     id: function() { return this._id = (this._id + 1) % MAX_ID; },
     response: {}
   };
+  var updates = {};
+  var outbound = [];
+  var reconnects = 0;
 
   if (window.chrome) {
     console.log(
@@ -76,9 +85,10 @@
    * Call a server method
    * @param {string} methodName method name
    * @param {Array} args
+   * @param {number} timeout optional deadline in seconds
    * @returns {object} resume generator
    */
-  avalon.call = function call(methodName, args) {
+  avalon.call = function call(methodName, args, timeout) {
     if (!avalon.channel || avalon.channel.readyState !== SockJS.OPEN) {
       throw new RuntimeError('Not connected');
     }
@@ -86,7 +96,8 @@
     avalon.channel.send(JSON.stringify({
       id: id,
       method: 'rpc',
-      params: [methodName, args]
+      params: [methodName, args],
+      timeout: timeout
     }));
     return rpc.response[id] = Promise(id);
   };
@@ -103,12 +114,449 @@
   };
 
 
+  /**
+   * Document id usable as an index key
+   * @param {object} doc
+   * @returns {string}
+   */
+  function docId(doc) {
+    return doc._id && doc._id.$oid || avalon.stringify(doc._id);
+  }
+
+  /**
+   * Bump the version of a result set or document, which watches compare
+   * instead of the value itself
+   * @param {object} obj
+   */
+  function touch(obj) {
+    if (obj.$$version === undefined) {
+      if (!Object.defineProperty) return;
+      Object.defineProperty(obj, '$$version', {
+        value: 0, writable: true, configurable: true, enumerable: false
+      });
+    }
+    obj.$$version++;
+  }
+
+  /**
+   * Merge documents into a result set by _id
+   * @param {Array} result
+   * @param {Array} docs
+   * @param {Array} removed optional ids of documents to remove
+   */
+  function merge(result, docs, removed) {
+    var i;
+    touch(result);
+    for (i = 0; i < docs.length; i++) {
+      var doc = docs[i];
+      touch(doc);
+      var _id = docId(doc);
+      var index = result.index[_id];
+      if (index !== undefined) {
+        result[index] = doc;
+      }
+      else {
+        index = result.push(doc) - 1;
+        result.index[_id] = index;
+      }
+    }
+
+    if (!removed || !removed.length) return;
+    for (i = 0; i < removed.length; i++) {
+      var remove = result.index[docId({_id: removed[i]})];
+      if (remove !== undefined) result[remove] = undefined;
+    }
+
+    var n = 0;
+    result.index = {};
+    for (i = 0; i < result.length; i++) {
+      if (result[i] === undefined) continue;
+      result[n] = result[i];
+      result.index[docId(result[n])] = n++;
+    }
+    result.length = n;
+  }
+
+  /**
+   * Apply the position changes of a sorted subscription to a result set
+   * @param {Array} result
+   * @param {Array} changes
+   */
+  function reposition(result, changes) {
+    var i;
+    touch(result);
+    for (i = 0; i < changes.length; i++) {
+      var change = changes[i];
+      if (change.doc) touch(change.doc);
+      switch (change.op) {
+        case 'insert':
+          result.splice(change.index, 0, change.doc);
+          break;
+        case 'move':
+          result.splice(change.from, 1);
+          result.splice(change.to, 0, change.doc);
+          break;
+        case 'remove':
+          result.splice(change.index, 1);
+          break;
+      }
+    }
+
+    result.index = {};
+    for (i = 0; i < result.length; i++) {
+      result.index[docId(result[i])] = i;
+    }
+  }
+
+  /**
+   * Comparable form of a value, e.g. of an ObjectId or date
+   * @param {*} value
+   * @returns {*}
+   */
+  function comparable(value) {
+    if (value && value.$oid !== undefined) return value.$oid;
+    if (value && value.$date !== undefined) return value.$date;
+    if (value !== null && typeof value === 'object') {
+      return avalon.stringify(value);
+    }
+    return value;
+  }
+
+  /**
+   * Compare values, ordering mixed types consistently with null first
+   * @param {*} a
+   * @param {*} b
+   * @returns {number}
+   */
+  function compare(a, b) {
+    a = comparable(a);
+    b = comparable(b);
+    if (a === b) return 0;
+    if (a === null || a === undefined) return -1;
+    if (b === null || b === undefined) return 1;
+    if (typeof a !== typeof b) return typeof a < typeof b ? -1 : 1;
+    return a < b ? -1 : a > b ? 1 : 0;
+  }
+
+  /**
+   * Value of a dotted field of a document
+   * @param {object} doc
+   * @param {string} name
+   * @returns {*} value, undefined if missing
+   */
+  function field(doc, name) {
+    var parts = name.split('.');
+    for (var i = 0; i < parts.length; i++) {
+      if (doc === null || typeof doc !== 'object' ||
+          !doc.hasOwnProperty(parts[i])) {
+        return undefined;
+      }
+      doc = doc[parts[i]];
+    }
+    return doc;
+  }
+
+  function isOperator(condition) {
+    if (condition === null || typeof condition !== 'object' ||
+        condition instanceof Array) {
+      return false;
+    }
+    for (var k in condition) {
+      if (condition.hasOwnProperty(k) && k.charAt(0) === '$' &&
+          k !== '$oid' && k !== '$date') {
+        return true;
+      }
+    }
+    return false;
+  }
+
+  function contains(values, value) {
+    for (var i = 0; i < values.length; i++) {
+      if (compare(values[i], value) === 0) return true;
+    }
+    return false;
+  }
+
+  function matchValue(value, condition) {
+    if (!isOperator(condition)) {
+      if (value instanceof Array && !(condition instanceof Array)) {
+        return contains(value, condition);
+      }
+      return value !== undefined && compare(value, condition) === 0 ||
+        value === undefined && condition === null;
+    }
+
+    for (var op in condition) {
+      if (!condition.hasOwnProperty(op)) continue;
+      var operand = condition[op];
+      if (op === '$exists') {
+        if ((value !== undefined) !== !!operand) return false;
+        continue;
+      }
+
+      var v = value === undefined ? null : value;
+      switch (op) {
+        case '$ne':
+          if (compare(v, operand) === 0) return false;
+          break;
+        case '$in':
+          if (!contains(operand, v)) return false;
+          break;
+        case '$nin':
+          if (contains(operand, v)) return false;
+          break;
+        case '$gt':
+        case '$gte':
+        case '$lt':
+        case '$lte':
+          if (v === null) return false;
+          var c = compare(v, operand);
+          if (op === '$gt' && c <= 0 || op === '$gte' && c < 0 ||
+              op === '$lt' && c >= 0 || op === '$lte' && c > 0) {
+            return false;
+          }
+          break;
+        default:
+          // Unsupported operators cannot be evaluated locally
+          return undefined;
+      }
+    }
+    return true;
+  }
+
+  var OPERATORS = ['$exists', '$ne', '$in', '$nin', '$gt', '$gte', '$lt',
+                   '$lte'];
+
+  /**
+   * Whether a query only uses operators that can be evaluated locally
+   * @param {object} query
+   * @returns {boolean}
+   */
+  function supported(query) {
+    for (var key in query) {
+      if (!query.hasOwnProperty(key)) continue;
+      var condition = query[key];
+
+      if (key === '$and' || key === '$or' || key === '$nor') {
+        for (var i = 0; i < condition.length; i++) {
+          if (!supported(condition[i])) return false;
+        }
+      }
+      else if (key.charAt(0) === '$') {
+        return false;
+      }
+      else if (isOperator(condition)) {
+        for (var op in condition) {
+          if (!condition.hasOwnProperty(op)) continue;
+          if (!contains(OPERATORS, op)) return false;
+        }
+      }
+    }
+    return true;
+  }
+
+  /**
+   * Whether a document matches a Mongo query
+   * @param {object} query
+   * @param {object} doc
+   * @returns {boolean} undefined if the query cannot be evaluated locally
+   */
+  avalon.match = function match(query, doc) {
+    var i, result = true;
+    for (var key in query) {
+      if (!query.hasOwnProperty(key)) continue;
+      var condition = query[key];
+      var m;
+
+      if (key === '$and' || key === '$or' || key === '$nor') {
+        var any = false, all = true;
+        for (i = 0; i < condition.length; i++) {
+          m = match(condition[i], doc);
+          if (m === undefined) return undefined;
+          any = any || m;
+          all = all && m;
+        }
+        m = key === '$and' ? all : key === '$or' ? any : !any;
+      }
+      else {
+        m = matchValue(field(doc, key), condition);
+        if (m === undefined) return undefined;
+      }
+      result = result && m;
+    }
+    return result;
+  };
+
+  /**
+   * Evaluate a query with sort and limit over documents
+   * @param {Array} docs
+   * @param {object} query
+   * @param {object} options optional `sort` and `limit`
+   * @returns {Array} matching documents
+   */
+  function evaluate(docs, query, options) {
+    var result = [];
+    for (var i = 0; i < docs.length; i++) {
+      if (avalon.match(query, docs[i])) result.push(docs[i]);
+    }
+
+    var sort = (options && options.sort || []).concat([['_id', 1]]);
+    result.sort(function(a, b) {
+      for (var i = 0; i < sort.length; i++) {
+        var c = compare(field(a, sort[i][0]), field(b, sort[i][0]));
+        if (c) return sort[i][1] < 0 ? -c : c;
+      }
+      return 0;
+    });
+
+    if (options && options.limit) result.length = Math.min(
+      result.length, options.limit);
+    return result;
+  }
+
+  /**
+   * Whether every condition of `parent` is also a condition of `query`,
+   * so the documents matching `query` are a subset of those of `parent`
+   * @param {object} query
+   * @param {object} parent
+   * @returns {boolean}
+   */
+  function narrows(query, parent) {
+    for (var k in parent) {
+      if (!parent.hasOwnProperty(k)) continue;
+      if (!query.hasOwnProperty(k) ||
+          avalon.stringify(query[k]) !== avalon.stringify(parent[k])) {
+        return false;
+      }
+    }
+    return true;
+  }
+
+  /**
+   * Apply update operations to a copy of a document
+   * @param {object} doc
+   * @param {object} operations e.g. `{$set: {name: 'x'}, $inc: {n: 1}}`
+   * @returns {object} updated document
+   */
+  function modify(doc, operations) {
+    doc = JSON.parse(JSON.stringify(doc));
+    for (var op in operations) {
+      if (!operations.hasOwnProperty(op)) continue;
+      var fields = operations[op];
+
+      for (var name in fields) {
+        if (!fields.hasOwnProperty(name)) continue;
+        var value = fields[name];
+        var parts = name.split('.');
+        var last = parts.pop();
+        var parent = doc;
+        for (var i = 0; i < parts.length; i++) {
+          if (typeof parent[parts[i]] !== 'object' ||
+              parent[parts[i]] === null) {
+            parent[parts[i]] = {};
+          }
+          parent = parent[parts[i]];
+        }
+
+        var values = value && value.$each || [value];
+        switch (op) {
+          case '$set':
+            parent[last] = value;
+            break;
+          case '$unset':
+            delete parent[last];
+            break;
+          case '$inc':
+            parent[last] = (parent[last] || 0) + value;
+            break;
+          case '$push':
+            parent[last] = (parent[last] || []).concat(values);
+            break;
+          case '$addToSet':
+            parent[last] = parent[last] || [];
+            for (i = 0; i < values.length; i++) {
+              if (!contains(parent[last], values[i])) {
+                parent[last].push(values[i]);
+              }
+            }
+            break;
+          case '$pull':
+            var kept = [];
+            for (i = 0; i < (parent[last] || []).length; i++) {
+              if (compare(parent[last][i], value)) kept.push(parent[last][i]);
+            }
+            parent[last] = kept;
+            break;
+          case '$pop':
+            if (parent[last]) parent[last].splice(value < 0 ? 0 : -1, 1);
+            break;
+          default:
+            console.error('Unsupported update operation: ' + op);
+        }
+      }
+    }
+    return doc;
+  }
+
+  var digestPending = false;
+
+  /**
+   * Schedule a digest of the root scope. Changes arriving before it runs
+   * share the same digest, so bursts of messages cost one digest per
+   * animation frame or `avalon.digestInterval`.
+   */
+  avalon.digest = function digest() {
+    if (digestPending) return;
+    digestPending = true;
+
+    var defer = avalon.digestInterval === null &&
+      window.requestAnimationFrame ?
+      function(f) { window.requestAnimationFrame(f); } :
+      function(f) { window.setTimeout(f, avalon.digestInterval || 16); };
+
+    defer(function run() {
+      if (!avalon.scope) {
+        window.setTimeout(run, 100);
+        return;
+      }
+      digestPending = false;
+      avalon.metrics.digests++;
+      avalon.scope.$apply();
+    });
+  };
+
+  /**
+   * Jittered exponential backoff delay
+   * @param {number} attempt number of attempts made so far
+   * @returns {number} delay in ms
+   */
+  function backoff(attempt) {
+    var delay = Math.min(MAX_BACKOFF, BACKOFF * Math.pow(2, attempt));
+    return delay / 2 + Math.random() * delay / 2;
+  }
+
+  /**
+   * Send the queued messages as a single frame, in the order they were
+   * queued, once the channel is open
+   */
+  function flush() {
+    var channel = avalon.channel;
+    if (!outbound.length || channel.readyState !== SockJS.OPEN) return;
+
+    var frame = outbound.length === 1 ?
+      outbound[0] : '[' + outbound.join(',') + ']';
+    outbound = [];
+    channel._send(frame);
+  }
+
   (function connect() {
     var channel = avalon.channel = new SockJS('/_avalon');
 
     channel.onopen = function() {
       console.log('Channel connected...');
+      reconnects = 0;
       channel.subscribe();
+      flush();
     };
 
     channel.onmessage = function(e) {
@@ -124,28 +572,60 @@
             return;
           }
 
-          for (var i = 0; i < data.result.length; i++) {
-            var doc = data.result[i];
-            var _id = doc._id.$oid || doc._id;
-            var index = subscription.result.index[_id];
-            if (index !== undefined) {
-              subscription.result[index] = doc;
+          if (data.error) {
+            console.error('Subscription failed: ' + data.error);
+            subscription.state = 'CLOSED';
+            window.setTimeout(function() {
+              avalon.channel.subscribe();
+            }, backoff(subscription.retries++));
+            return;
+          }
+
+          if (data.sorted) {
+            subscription.result.length = 0;
+            subscription.result.index = {};
+          }
+
+          if (data.changes) {
+            for (var i = 0; i < data.changes.length; i++) {
+              if (data.changes[i].doc) {
+                data.changes[i].doc = collection.reconcile(
+                  data.changes[i].doc);
+              }
             }
-            else {
-              index = subscription.result.push(doc) - 1;
-              subscription.result.index[_id] = index;
+            reposition(subscription.result, data.changes);
+          }
+          else {
+            if (!subscription.options || !subscription.options.aggregate) {
+              for (var i = 0; i < data.result.length; i++) {
+                data.result[i] = collection.reconcile(data.result[i]);
+              }
             }
+            merge(subscription.result, data.result, data.removed);
           }
 
-          (function apply() {
-            if (!avalon.scope) {
-              window.setTimeout(apply, 1000);
-              return;
-            }
-            avalon.scope.$apply();
-          })();
+          if (!subscription.options || !subscription.options.aggregate) {
+            collection.remember(subscription.result);
+          }
+          if (data.sorted || data.changes ||
+              (data.removed && data.removed.length)) {
+            collection.prune();
+          }
+          subscription.loaded = true;
+          collection.refresh(data.query);
+
+          avalon.digest();
 
           subscription.state = 'OPEN';
+          subscription.retries = 0;
+          delete subscription.since;
+          break;
+        case 'update':
+          var update = updates[data.id];
+          if (!update) break;
+          delete updates[data.id];
+          avalon.model[update.collection].settle(update, data.error,
+            data.result);
           break;
         case 'rpc':
           if (!rpc.response[data.id]) {
@@ -153,7 +633,14 @@
             break;
           }
           var promise = rpc.response[data.id];
-          promise.set_result(data.result);
+          delete rpc.response[data.id];
+          if (data.error) {
+            console.error('RPC ' + data.id + ' failed: ' + data.error);
+            promise.set_error(data.error);
+          }
+          else {
+            promise.set_result(data.result);
+          }
           schedule(promise);
           break;
         default:
@@ -163,10 +650,26 @@
     };
 
     channel.onclose = function() {
-      console.error('Channel connection lost, reconnecting...');
-      window.setTimeout(function() {
-        connect();
-      }, 1000);
+      var delay = backoff(reconnects++);
+      console.error('Channel connection lost, reconnecting in ' +
+        Math.round(delay) + 'ms...');
+      window.setTimeout(connect, delay);
+
+      // Acks of the updates in flight are lost with the connection, so
+      // roll them back rather than wait for them forever, and do not send
+      // those still queued
+      var rollback = {};
+      for (var id in updates) {
+        if (!updates.hasOwnProperty(id)) continue;
+        var update = updates[id];
+        delete updates[id];
+        rollback[id] = true;
+        avalon.model[update.collection].settle(update, 'disconnected');
+      }
+      outbound = outbound.filter(function(frame) {
+        var message = JSON.parse(frame);
+        return message.method !== 'update' || !rollback[message.id];
+      });
 
       for (var collection in avalon.model) {
         if (!avalon.model.hasOwnProperty(collection)) continue;
@@ -175,6 +678,7 @@
           if (!subscriptions.hasOwnProperty(sub_id)) continue;
           subscriptions[sub_id].state = 'CLOSED';
         }
+        avalon.model[collection].forget();
       }
     };
 
@@ -189,36 +693,30 @@
           if (!subscriptions.hasOwnProperty(sub_id)) continue;
 
           var subscription = subscriptions[sub_id];
-          if (subscription.state != 'CLOSED') continue;
+          if (subscription.state != 'CLOSED' || subscription.local) continue;
+
+          // Preloaded subscriptions only need the changes made since
+          var params = [collection, subscription.query];
+          if (subscription.since) params.push(subscription.since);
 
           this.send(JSON.stringify({
             method: 'subscribe',
-            params: [collection, subscription.query]
+            params: params
           }));
 
+          // Pending until the server acknowledges it, with the result or
+          // an error
           subscription.state = 'PENDING';
-          (function(subscription) {
-            window.setTimeout(function pending() {
-              if (subscription.state === 'OPEN') return;
-              subscription.state = 'CLOSED';
-              avalon.channel.subscribe();
-            }, 1000);
-          })(subscription);
         }
       }
     };
 
     channel._send = channel.send;
     channel.send = function send(data) {
-      // Use `avalon.channel` rather than `this` because we always want to
-      // refer to the currently active channel
-      (function send() {
-        if (avalon.channel.readyState === SockJS.OPEN) {
-          avalon.channel._send(data);
-          return
-        }
-        window.setTimeout(send, 1000);
-      })();
+      // Queue rather than send, so messages sent together share a frame
+      // and messages sent while disconnected go out once reconnected
+      outbound.push(data);
+      if (outbound.length === 1) window.setTimeout(flush, 0);
     };
   })();
 
@@ -226,37 +724,348 @@
   var Collection = function Collection(collection) {
     this.collection = collection;
     this.subscriptions = {};
+    this.cache = {};
+    this.authoritative = {};
+    this.pending = [];
   };
 
-  Collection.prototype.subscribe = function subscribe(query) {
-    var subscriptions = avalon.model[this.collection].subscriptions;
+  /**
+   * Add documents to the collection cache
+   * @param {Array} docs
+   */
+  Collection.prototype.remember = function remember(docs) {
+    for (var i = 0; i < docs.length; i++) {
+      this.cache[docId(docs[i])] = docs[i];
+    }
+  };
+
+  /**
+   * Drop cached documents no longer held by any subscription, unless
+   * updates to them are pending
+   */
+  Collection.prototype.prune = function prune() {
+    var held = {}, k;
+    for (var sub_id in this.subscriptions) {
+      if (!this.subscriptions.hasOwnProperty(sub_id)) continue;
+      var subscription = this.subscriptions[sub_id];
+      if (subscription.local ||
+          (subscription.options && subscription.options.aggregate)) {
+        continue;
+      }
+      for (k in subscription.result.index) {
+        if (subscription.result.index.hasOwnProperty(k)) held[k] = true;
+      }
+    }
+
+    for (k in this.cache) {
+      if (this.cache.hasOwnProperty(k) && !held[k] &&
+          !this.authoritative[k]) {
+        delete this.cache[k];
+      }
+    }
+  };
+
+  /**
+   * Cached document by _id
+   * @param {*} _id
+   * @returns {object} document, undefined if not cached
+   */
+  Collection.prototype.get = function get(_id) {
+    return this.cache[docId({_id: _id})];
+  };
+
+  /**
+   * Evaluate a query against the cached documents
+   * @param {object} query
+   * @param {object} options optional `sort` and `limit`
+   * @returns {Array} matching documents
+   */
+  Collection.prototype.find = function find(query, options) {
+    var docs = [];
+    for (var k in this.cache) {
+      if (this.cache.hasOwnProperty(k)) docs.push(this.cache[k]);
+    }
+    return evaluate(docs, query || {}, options);
+  };
+
+  /**
+   * Loaded subscription holding every document of a query, from which
+   * the query can be answered locally
+   * @param {object} query
+   * @param {object} options
+   * @returns {object} subscription, undefined if there is none
+   */
+  Collection.prototype.cover = function cover(query, options) {
+    for (var k in options) {
+      if (options.hasOwnProperty(k) && k !== 'sort' && k !== 'limit') return;
+    }
+    if (!supported(query)) return;
+
+    for (var sub_id in this.subscriptions) {
+      if (!this.subscriptions.hasOwnProperty(sub_id)) continue;
+      var subscription = this.subscriptions[sub_id];
+
+      // Only plain subscriptions hold every matching document, up to the
+      // server snapshot limit
+      if (!subscription.loaded || subscription.local ||
+          subscription.options || subscription.result.length >= 1000) {
+        continue;
+      }
+      if (narrows(query, subscription.filter)) return subscription;
+    }
+  };
+
+  /**
+   * Recompute the local subscriptions answered from a subscription
+   * @param {string} query key of the subscription
+   */
+  Collection.prototype.refresh = function refresh(query) {
+    var parent = this.subscriptions[query];
+    for (var sub_id in this.subscriptions) {
+      if (!this.subscriptions.hasOwnProperty(sub_id)) continue;
+      var subscription = this.subscriptions[sub_id];
+      if (subscription.local !== query) continue;
+
+      var docs = evaluate(parent.result, subscription.filter,
+        subscription.options);
+      var result = subscription.result;
+      result.length = 0;
+      result.index = {};
+      merge(result, docs);
+    }
+  };
 
+  /**
+   * Subscription key for a query
+   * @param {object} query
+   * @param {object} options
+   * @returns {string}
+   */
+  function queryKey(query, options) {
     // Use deterministic stringify because we want the same query
     // to map to the same subscription result set
-    query = avalon.stringify(query || {});
-    if (subscriptions[query]) return subscriptions[query];
+    return options ?
+      avalon.stringify({$query: query || {}, $options: options}) :
+      avalon.stringify(query || {});
+  }
+
+  /**
+   * Subscribe to a live query
+   * @param {object} query
+   * @param {object} options subscription options, e.g.
+   *   `{fanout: {debounce: 100}}` or `{fanout: {rate: 10}}`, and
+   *   `{sort: [['score', -1]], limit: 50}` for a sorted window
+   * @returns {Array} live result set
+   */
+  Collection.prototype.subscribe = function subscribe(query, options) {
+    var subscriptions = avalon.model[this.collection].subscriptions;
+
+    var key = queryKey(query, options);
+    if (subscriptions[key]) {
+      subscriptions[key].refs++;
+      return subscriptions[key].result;
+    }
 
     var result = [];
     result.index = {};
-    subscriptions[query] = {
+    subscriptions[key] = {
       result: result,
-      query: query,
-      state: 'CLOSED'
+      query: key,
+      filter: query || {},
+      options: options,
+      state: 'CLOSED',
+      refs: 1,
+      retries: 0
     };
 
+    // Answer narrower queries from a subscription already loaded, which
+    // is kept alive for as long as this one is
+    var cover = this.cover(query || {}, options);
+    if (cover) {
+      cover.refs++;
+      subscriptions[key].local = cover.query;
+      subscriptions[key].loaded = true;
+      subscriptions[key].state = 'OPEN';
+      this.refresh(cover.query);
+      return result;
+    }
+
     avalon.channel.subscribe();
     return result;
   };
 
+  /**
+   * Release a live query, e.g. when the scope using it is destroyed. The
+   * server subscription is dropped once every subscriber has released it.
+   * @param {object} query
+   * @param {object} options
+   */
+  Collection.prototype.unsubscribe = function unsubscribe(query, options) {
+    this.release(queryKey(query, options));
+  };
+
+  Collection.prototype.release = function release(query) {
+    var subscriptions = avalon.model[this.collection].subscriptions;
+
+    var subscription = subscriptions[query];
+    if (!subscription || --subscription.refs > 0) return;
+
+    delete subscriptions[query];
+    this.prune();
+    if (subscription.local) {
+      this.release(subscription.local);
+      return;
+    }
+    if (subscription.state === 'CLOSED') return;
+
+    avalon.channel.send(JSON.stringify({
+      method: 'unsubscribe',
+      params: [this.collection, query]
+    }));
+  };
+
+  /**
+   * Subscribe to a live aggregation of a query
+   * @param {object} query
+   * @param {object} spec e.g. `{group: 'country', count: true,
+   *   sum: ['amount'], avg: ['amount'], min: ['amount'], max: ['amount']}`
+   * @param {object} options other subscription options
+   * @returns {Array} live group rows, `{_id: group, count: n,
+   *   sum: {amount: s}, ...}`
+   */
+  Collection.prototype.aggregate = function aggregate(query, spec, options) {
+    var aggregateOptions = {aggregate: spec};
+    for (var k in options) {
+      if (options.hasOwnProperty(k)) aggregateOptions[k] = options[k];
+    }
+    return this.subscribe(query, aggregateOptions);
+  };
+
+  /**
+   * Update a document, applying the operations to the local copy at once.
+   * The local copy is reconciled with the server version as it arrives,
+   * and rolled back if the server rejects the update.
+   * @param {object} obj document
+   * @param {object} operations e.g. `{$set: {name: 'x'}}`
+   */
   Collection.prototype.update = function update(obj, operations) {
     if (!obj._id) {
       console.error('Object has no _id', obj);
       return;
     }
+    operations = operations || {};
+
+    var id = rpc.id();
+    var _id = docId(obj);
+    if (!this.authoritative[_id]) {
+      this.authoritative[_id] = this.cache[_id] || obj;
+    }
+    this.pending.push(updates[id] = {
+      id: id,
+      collection: this.collection,
+      _id: _id,
+      operations: operations
+    });
+    avalon.metrics.updates++;
+    this.replace(modify(this.cache[_id] || obj, operations));
+
     avalon.channel.send(JSON.stringify({
+      id: id,
       method: 'update',
-      params: [this.collection, {_id: obj._id}, operations || {}]
-    }))
+      params: [this.collection, {_id: obj._id}, operations]
+    }));
+  };
+
+  /**
+   * Local version of a document sent by the server. While updates to it
+   * are pending the server version is only kept, since it is unknown
+   * whether it includes them.
+   * @param {object} doc server version
+   * @returns {object} local version
+   */
+  Collection.prototype.reconcile = function reconcile(doc) {
+    var _id = docId(doc);
+    if (!this.authoritative[_id]) return doc;
+
+    this.authoritative[_id] = doc;
+    return this.cache[_id] || doc;
+  };
+
+  /**
+   * Complete a local update once the server has applied or rejected it
+   * @param {object} update
+   * @param {string} error
+   * @param {Array} docs documents as updated by the server
+   */
+  Collection.prototype.settle = function settle(update, error, docs) {
+    var i, pending = [];
+    for (i = 0; i < this.pending.length; i++) {
+      if (this.pending[i] === update) break;
+    }
+    this.pending.splice(i, 1);
+    for (i = 0; i < this.pending.length; i++) {
+      if (this.pending[i]._id === update._id) pending.push(this.pending[i]);
+    }
+
+    var doc = this.authoritative[update._id];
+    if (error) {
+      console.error('Update ' + update.id + ' failed: ' + error);
+      avalon.metrics.rollbacks++;
+    }
+    else {
+      for (i = 0; i < (docs || []).length; i++) {
+        if (docId(docs[i]) === update._id) doc = docs[i];
+      }
+    }
+
+    // Rebase the updates still pending on the server version
+    if (pending.length) {
+      this.authoritative[update._id] = doc;
+      for (i = 0; i < pending.length; i++) {
+        doc = modify(doc, pending[i].operations);
+      }
+    }
+    else {
+      delete this.authoritative[update._id];
+    }
+    this.replace(doc);
+    avalon.digest();
+  };
+
+  /**
+   * Stop holding back the server version of documents with no pending
+   * updates
+   */
+  Collection.prototype.forget = function forget() {
+    var pending = {};
+    for (var i = 0; i < this.pending.length; i++) {
+      pending[this.pending[i]._id] = true;
+    }
+    for (var _id in this.authoritative) {
+      if (this.authoritative.hasOwnProperty(_id) && !pending[_id]) {
+        delete this.authoritative[_id];
+      }
+    }
+  };
+
+  /**
+   * Replace a document in the cache and every result set holding it
+   * @param {object} doc
+   */
+  Collection.prototype.replace = function replace(doc) {
+    var _id = docId(doc);
+    touch(doc);
+    this.cache[_id] = doc;
+    for (var sub_id in this.subscriptions) {
+      if (!this.subscriptions.hasOwnProperty(sub_id)) continue;
+      var subscription = this.subscriptions[sub_id];
+      var index = subscription.result.index[_id];
+      if (index !== undefined && !subscription.local) {
+        subscription.result[index] = doc;
+        touch(subscription.result);
+        this.refresh(sub_id);
+      }
+    }
   };
 
   var Store = function Store() {};
@@ -267,4 +1076,37 @@
   };
 
   avalon.model = new Store();
+
+  /**
+   * Hydrate the subscriptions preloaded into the page by the server
+   */
+  (function preload() {
+    var element = document.getElementById('avalon-preload');
+    if (!element) return;
+
+    var preloads = JSON.parse(element.textContent || element.text);
+    for (var i = 0; i < preloads.length; i++) {
+      var p = preloads[i];
+      var collection = avalon.model[p.collection] ||
+        avalon.model.__getattr__(avalon.model, p.collection);
+      var query = queryKey(p.query, p.options);
+
+      var result = [];
+      result.index = {};
+      merge(result, p.result);
+      collection.remember(result);
+      collection.subscriptions[query] = {
+        result: result,
+        query: query,
+        filter: p.query,
+        options: p.options,
+        state: 'CLOSED',
+        loaded: true,
+        refs: 0,
+        retries: 0,
+        since: p.since
+      };
+    }
+    avalon.channel.subscribe();
+  })();
 })(this)
@@ -5,12 +5,36 @@
 #==============================================================================
 
 import os
+import time
 
 from argparse import ArgumentParser
 from six.moves.configparser import ConfigParser, NoSectionError
 from . import server
 
 CONFIG_FILE = 'avalon.conf'
+DB_OPTIONS = {
+    'max_pool_size': int,
+    'max_concurrent': int,
+    'max_wait_time': float,
+    'read_preference': str,
+    'snapshot_read_preference': str,
+    'replicaSet': str
+}
+
+
+def db_options(config):
+    if not config.has_section('db'):
+        return {}
+
+    options = {}
+    for name, value in config.items('db', raw=True):
+        if name in config.defaults():
+            continue
+        # ConfigParser lowercases option names
+        name = next((o for o in DB_OPTIONS if o.lower() == name), None)
+        if name:
+            options[name] = DB_OPTIONS[name](value)
+    return options
 
 
 def serve(args):
@@ -29,8 +53,68 @@ def serve(args):
     else:
         cdn = args.cdn
 
+    if args.minify is None:
+        if config.has_option('app', 'minify'):
+            minify = config.getboolean('app', 'minify')
+        else:
+            minify = False
+    else:
+        minify = args.minify
+
+    if config.has_option('app', 'split_scripts'):
+        split_scripts = config.getboolean('app', 'split_scripts')
+    else:
+        split_scripts = False
+
+    if args.dist is None and config.has_option('app', 'dist'):
+        dist = config.get('app', 'dist')
+    else:
+        dist = args.dist
+
     server.serve(db=config.get('app', 'db'), port=port, verbose=args.verbose,
-                 view_path=view_path, controller_path=controller_path, cdn=cdn)
+                 view_path=view_path, controller_path=controller_path, cdn=cdn,
+                 db_options=db_options(config), minify=minify,
+                 workers=args.workers, split_scripts=split_scripts,
+                 dist=dist)
+
+
+def build(args):
+    config = ConfigParser()
+    config.read([CONFIG_FILE])
+
+    def option(name, default):
+        if config.has_option('app', name):
+            return config.getboolean('app', name)
+        return default
+
+    view_path = getattr(args, 'view_path', None)
+    controller_path = getattr(args, 'controller_path', None)
+    cdn = option('cdn', True) if args.cdn is None else args.cdn
+    minify = option('minify', True) if args.minify is None else args.minify
+
+    start = time.time()
+    manifest = server.build_static(
+        output=args.output, view_path=view_path,
+        controller_path=controller_path, cdn=cdn, minify=minify,
+        workers=args.workers, split_scripts=option('split_scripts', False),
+        verbose=args.verbose)
+    print('Built {0} into {1} ({2:.2f}s), serve with --dist {1}'.format(
+        manifest['index'], args.output, time.time() - start))
+
+
+def compile(args):
+    from .compiler import cache
+
+    if args.cache:
+        cache.path = args.cache
+    controller_path = getattr(args, 'controller_path', None)
+
+    start = time.time()
+    code = server.compile(controller_path=controller_path,
+                          verbose=args.verbose, workers=args.workers)
+    print('Compiled runtime and {0} client functions into {1} '
+          '({2:.2f}s, {3} workers)'.format(len(code) - 1, cache.path,
+                                           time.time() - start, args.workers))
 
 
 def init(args):
@@ -59,8 +143,36 @@ def main():
     cmd.add_argument('-p', dest='port', help='port', default=None)
     cmd.add_argument('--local', dest='cdn', action='store_false',
                      default=None, help='do not use cdn')
+    cmd.add_argument('--minify', dest='minify', action='store_true',
+                     default=None, help='minify compiled client code')
+    cmd.add_argument('-j', dest='workers', type=int, default=1,
+                     help='compile with a pool of processes at startup')
+    cmd.add_argument('--dist', dest='dist', default=None,
+                     help='serve a build instead of compiling')
     cmd.add_argument('-v', dest='verbose', action='store_true', help='verbose')
     cmd.set_defaults(func=serve)
 
+    cmd = command.add_parser('build', help='build the page, styles and '
+                                          'client code ahead of time')
+    cmd.add_argument('-o', dest='output', default='dist',
+                     help='output directory')
+    cmd.add_argument('--local', dest='cdn', action='store_false',
+                     default=None, help='do not use cdn')
+    cmd.add_argument('--no-minify', dest='minify', action='store_false',
+                     default=None, help='do not minify compiled client code')
+    cmd.add_argument('-j', dest='workers', type=int, default=1,
+                     help='number of compiler processes')
+    cmd.add_argument('-v', dest='verbose', action='store_true', help='verbose')
+    cmd.set_defaults(func=build)
+
+    cmd = command.add_parser('compile', help='compile client code into the '
+                                            'compile cache')
+    cmd.add_argument('--cache', dest='cache', default=None,
+                     help='cache directory')
+    cmd.add_argument('-j', dest='workers', type=int, default=1,
+                     help='number of compiler processes')
+    cmd.add_argument('-v', dest='verbose', action='store_true', help='verbose')
+    cmd.set_defaults(func=compile)
+
     args = args.parse_args()
     args.func(args)
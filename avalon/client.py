@@ -70,6 +70,7 @@ class Promise(object):
     def __init__(self, _id):
         self._id = _id
         self.result = None
+        self.error = None
         self.have_result = False
         self.task = None
 
@@ -77,10 +78,81 @@ class Promise(object):
         self.result = value
         self.have_result = True
 
+    def set_error(self, error):
+        self.error = error
+        self.have_result = True
+
     def set_task(self, task):
         self.task = task
 
 
+@expose
+def delegate(element, name, selector, handler):
+    # Register a scope event handler in the handler table of its element.
+    # Events are dispatched from a single listener per event type at the
+    # document root, walking up from the target through the handler tables.
+    JSCode('''
+    var bubbles = [
+      'click', 'dblclick', 'contextmenu', 'mousedown', 'mouseup',
+      'mouseover', 'mouseout', 'mousemove', 'keydown', 'keyup', 'keypress',
+      'input', 'change', 'submit', 'focusin', 'focusout', 'touchstart',
+      'touchmove', 'touchend'
+    ];
+    var listening = delegate.listening = delegate.listening || {};
+
+    // Events that do not bubble are bound to the element as before
+    var type = {focus: 'focusin', blur: 'focusout'}[name] || name;
+    if (bubbles.indexOf(type) < 0) {
+      element.on(name, selector, handler);
+      return;
+    }
+
+    var node = element[0];
+    var table = node.$avalonEvents = node.$avalonEvents || {};
+    (table[type] = table[type] || []).push([selector, handler]);
+
+    if (listening[type]) return;
+    listening[type] = true;
+    function fire(handler, node, e) {
+      // Handlers see the element they fire for as `this` and
+      // `currentTarget`, as with jQuery delegated events
+      e.currentTarget = node;
+      handler.call(node, e);
+    }
+
+    angular.element(document).on(type, function dispatch(e) {
+      for (var n = e.target; n && !e.isPropagationStopped();
+           n = n.parentNode) {
+        var handlers = n.$avalonEvents && n.$avalonEvents[type];
+        if (!handlers) continue;
+
+        // Selector handlers fire once for every matching element from the
+        // target up to the element they are registered on, innermost first
+        var i;
+        for (var m = e.target; m !== n && !e.isPropagationStopped();
+             m = m.parentNode) {
+          for (i = 0; i < handlers.length; i++) {
+            if (handlers[i][0] && angular.element(m).is(handlers[i][0])) {
+              fire(handlers[i][1], m, e);
+            }
+          }
+        }
+        for (i = 0; i < handlers.length && !e.isPropagationStopped(); i++) {
+          if (!handlers[i][0]) fire(handlers[i][1], n, e);
+        }
+      }
+    });
+    ''')
+
+
+@expose
+def undelegate(element):
+    JSCode('''
+    element.off();
+    delete element[0].$avalonEvents;
+    ''')
+
+
 @expose
 def check(f, args):
     try:
@@ -97,13 +169,26 @@ def task(g):
     chain = []
     current = g
     res = None
+    error = None
     while current:
         try:
-            res = current.send(res)
+            if error is None:
+                res = current.send(res)
+            else:
+                thrown = error
+                error = None
+                res = current.throw(thrown)
         except StopIteration as e:
             res = e.value
             current = chain.pop()
             continue
+        except Exception as e:
+            # Raise in the generator that is waiting on this one
+            if not chain:
+                raise e
+            error = e
+            current = chain.pop()
+            continue
 
         if isinstance(res, JSCode.generator):
             chain.append(current)
@@ -112,12 +197,8 @@ def task(g):
             continue
 
         if hasattr(res, '__iter__'):
-            # TODO: use dict comprehension when available
             res = list(res)
-            wait = {}
-            for i, r in enumerate(res):
-                if isinstance(r, Promise):
-                    wait[r] = i
+            wait = {r: i for i, r in enumerate(res) if isinstance(r, Promise)}
 
             for i in range(len(wait)):
                 d = yield
@@ -126,7 +207,10 @@ def task(g):
             continue
 
         if isinstance(res, Promise):
-            res = yield res
+            try:
+                res = yield res
+            except Exception as e:
+                error = e
 
 
 @expose
@@ -141,16 +225,21 @@ def schedule(g):
             pass
     elif isinstance(g, JSCode.Promise) and g.task:
         try:
-            promise = g.task.send(g.result)
+            if g.error is None:
+                promise = g.task.send(g.result)
+            elif g.error == 'timeout':
+                promise = g.task.throw(JSCode.Timeout(g.error))
+            else:
+                promise = g.task.throw(JSCode.RPCError(g.error))
             if isinstance(promise, JSCode.Promise):
                 promise.set_task(g.task)
         except StopIteration:
             pass
 
 
-def compiled():
-    from .compiler import js_compile
-    return [js_compile(f) for f in _functions]
+def compiled(workers=1):
+    from .compiler import compile_all
+    return compile_all(_functions, workers)
 
 
 template = Scope()
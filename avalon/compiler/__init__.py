@@ -8,4 +8,5 @@
 Python to Javascript compiler
 """
 
-from .compiler import js_compile, runtime, JSCode
+from .compiler import compile_all, js_compile, runtime, runtime_modules, \
+    JSCode
@@ -44,6 +44,36 @@ def isinstance(obj, cls):
     JSCode('return obj instanceof cls;')
 
 
+def iter(obj):
+    # Iterators have a `step(done)` method, returning the next item or
+    # `done` once exhausted, so loops need not catch StopIteration
+    JSCode('''
+    if (obj instanceof Array || typeof obj === 'string') {
+      var i = 0;
+      return {step: function step(done) {
+        return i < obj.length ? obj[i++] : done;
+      }};
+    }
+    if (obj instanceof array) return iter(obj.array);
+    if (obj && obj.step) return obj;
+    if (obj && obj.__iter__) return iter(obj.__iter__());
+    if (obj && obj.next) {
+      return {step: function step(done) {
+        try {
+          return obj.next();
+        } catch (e) {
+          if (e instanceof StopIteration) return done;
+          throw e;
+        }
+      }};
+    }
+    if (obj && Object.getPrototypeOf(obj) === Object.prototype) {
+      return iter(Object.keys(obj));
+    }
+    ''')
+    raise TypeError('object is not iterable')
+
+
 def method(obj, func):
     JSCode('''
     return function() {
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Persistent compile cache, keyed by a hash of the source
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+from .. import _log
+
+# Cache directory, set to None to disable the cache
+path = os.environ.get('AVALON_COMPILE_CACHE',
+                      os.path.join('.avalon', 'cache'))
+
+
+def key(version, name, source, **options):
+    data = json.dumps([version, list(sys.version_info[:2]), name, source,
+                       options], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def get(k):
+    if not path:
+        return None
+
+    try:
+        with open(os.path.join(path, k + '.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def put(k, entry):
+    if not path:
+        return
+
+    # Write to a temporary file renamed into place, so processes sharing
+    # the cache never read a partial entry
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        fd, tmp = tempfile.mkstemp(dir=path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        try:
+            os.rename(tmp, os.path.join(path, k + '.json'))
+        except OSError:
+            # Already written by another process (Windows)
+            os.remove(tmp)
+    except (IOError, OSError) as e:
+        _log.warning('Compile cache not writable (%s): %s', path, e)
@@ -9,10 +9,20 @@ from __future__ import absolute_import
 import ast
 import inspect
 import json
+import multiprocessing
+import os
 import sys
 
 from types import ModuleType
 
+from . import cache
+
+# Bump when the generated code changes, invalidating the compile cache
+VERSION = 8
+
+# Objects being compiled by a process pool, inherited by the workers
+_pool_objs = None
+
 
 class JSCode(object):
     def __getattr__(self, name):
@@ -42,6 +52,110 @@ class YieldSearch(ast.NodeVisitor):
         pass
 
 
+class StateSearch(ast.NodeVisitor):
+    """Find statements that need a function compiled to a resumable state
+    machine"""
+
+    def visit_Yield(self, node):
+        self.found_state = True
+
+    def visit_TryExcept(self, node):
+        self.found_state = True
+
+    def visit_TryFinally(self, node):
+        self.found_state = True
+
+    def visit_Try(self, node):
+        self.found_state = True
+
+    def visit_ClassDef(self, node):
+        self.found_state = True
+
+    def visit_FunctionDef(self, node):
+        pass
+
+
+class LocalSearch(ast.NodeVisitor):
+    """Find the names assigned in a function body"""
+
+    def __init__(self):
+        self.names = []
+
+    def add(self, name):
+        if name not in self.names:
+            self.names.append(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Store):
+            self.add(node.id)
+
+    def visit_FunctionDef(self, node):
+        self.add(node.name)
+
+
+class TypeSearch(ast.NodeVisitor):
+    """Infer the types of the locals of a function. A local has a type only
+    if every assignment to it gives it that type."""
+
+    def __init__(self, compiler):
+        self.compiler = compiler
+        self.types = {}
+
+    def assign(self, name, type_name):
+        if self.types.get(name, type_name) != type_name:
+            type_name = None
+        self.types[name] = type_name
+
+    def visit_Assign(self, node):
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                self.assign(target.id,
+                            self.compiler.type_of(node.value, self.types))
+            else:
+                self.visit(target)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.assign(node.target.id, None)
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self.assign(node.id, None)
+
+    def visit_ExceptHandler(self, node):
+        if node.name and not isinstance(node.name, ast.AST):
+            self.assign(node.name, None)
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        self.assign(node.name, None)
+
+    def visit_ClassDef(self, node):
+        self.assign(node.name, None)
+
+
+class Raw(ast.expr):
+    """Javascript code in place of an expression"""
+    _fields = ('code',)
+
+
+class Locals(str):
+    """Context of names held in Javascript local variables"""
+
+LOCALS = Locals('locals')
+
+
+class Comprehension(str):
+    """Context of a comprehension, its targets are Javascript locals and
+    other names resolve in the enclosing context"""
+
+    def __new__(cls, names, parent):
+        context = str.__new__(cls, 'comprehension')
+        context.names = names
+        context.parent = parent
+        return context
+
+
 class NodeOptions(object):
     def __init__(self, options):
         self.__dict__.update(options)
@@ -89,9 +203,12 @@ class JSCompiler(ast.NodeVisitor):
         ast.IsNot: '!==',
     }
 
-    def __init__(self, obj):
+    def __init__(self, obj, straight_line=True):
         self.obj = obj
         self.node_chain = [None]
+        self.dependencies = {}
+        self.straight_line = straight_line
+        self.loop_count = 0
         if isinstance(obj, ModuleType):
             self.module = obj
         else:
@@ -109,26 +226,88 @@ class JSCompiler(ast.NodeVisitor):
             node.loop_point = getattr(node.parent, 'loop_point', None)
             node.break_point = getattr(node.parent, 'break_point', None)
             node.auto_yield = getattr(node.parent, 'auto_yield', False)
+            node.straight = getattr(node.parent, 'straight', False)
+            node.types = getattr(node.parent, 'types', None)
             node.context = node.context or node.parent.context
         else:
             node.branch = None
             node.loop_point = None
             node.break_point = None
             node.auto_yield = False
+            node.straight = False
+            node.types = None
 
         self.node_chain.append(node)
-        method = 'visit_' + node.__class__.__name__
-        method_func = getattr(self, method, self.generic_visit)
-        if len(inspect.getargspec(method_func).args) == 3:
-            ret = method_func(node, NodeOptions(kwargs))
+        method_func, options = self.dispatch(node.__class__)
+        if options:
+            ret = method_func(self, node, NodeOptions(kwargs))
         else:
-            ret = method_func(node)
+            ret = method_func(self, node)
         self.node_chain.pop()
         return ret
 
+    @classmethod
+    def dispatch(cls, node_class):
+        """Visit method for a node class, and whether it takes options"""
+        table = cls.__dict__.get('_dispatch')
+        if table is None:
+            table = cls._dispatch = {}
+
+        entry = table.get(node_class)
+        if entry is None:
+            method = 'visit_' + node_class.__name__
+            func = getattr(cls, method, cls.generic_visit)
+            func = getattr(func, '__func__', func)
+            entry = table[node_class] = (func, func.__code__.co_argcount == 3)
+        return entry
+
+    @classmethod
+    def environment(cls):
+        """Modules names are looked up in, imported once"""
+        env = cls.__dict__.get('_environment')
+        if env is None:
+            from . import builtins, exceptions, types
+            from .. import client, model
+            env = cls._environment = NodeOptions({
+                'builtins': builtins,
+                'exceptions': exceptions,
+                'types': types,
+                'client': client,
+                'model': model
+            })
+        return env
+
+    def resolve(self, kind, name):
+        """Resolve a name against the environment, recording the result so
+        cached code can be checked against the environment it was compiled
+        in"""
+        if kind == 'name':
+            value = self._lookup(name)
+        elif kind == 'jscode':
+            value = getattr(self.module, name, None) is JSCode
+        elif kind == 'scope':
+            value = self.environment().client._scopes.get(name, None)
+        elif kind == 'attribute':
+            value = self._has_attribute(*name.split('.', 1))
+        else:
+            raise ValueError('Unknown dependency kind {0}'.format(kind))
+
+        self.dependencies['{0}:{1}'.format(kind, name)] = value
+        return value
+
+    def resolves(self, dependencies):
+        """Whether recorded dependencies still resolve the same way"""
+        for k, value in dependencies.items():
+            kind, name = k.split(':', 1)
+            if json.loads(json.dumps(self.resolve(kind, name))) != value:
+                return False
+        return True
+
     def lookup(self, name):
-        from . import builtins, exceptions, types
-        from .. import client, model
+        return self.resolve('name', name)
+
+    def _lookup(self, name):
+        env = self.environment()
 
         if name == 'print':
             return name
@@ -139,24 +318,78 @@ class JSCompiler(ast.NodeVisitor):
         elif name == 'False':
             return 'false'
 
-        value = (getattr(builtins, name, None) or
-                 getattr(exceptions, name, None) or
-                 getattr(types, name, None) or
+        value = (getattr(env.builtins, name, None) or
+                 getattr(env.exceptions, name, None) or
+                 getattr(env.types, name, None) or
                  getattr(self.module, name, None))
 
         if value is None:
             return None
         elif value is JSCode:
             return name
-        elif value is client.session:
+        elif value is env.client.session:
             return 'avalon.session'
-        elif value is model.model:
+        elif value is env.model.model:
             return 'avalon.model'
         elif hasattr(value, '__server_method__'):
             method_name = value.__server_method__
             return 'avalon.method("{0}")'.format(method_name)
         return self.safe_name(name)
 
+    def infer_types(self, node):
+        """Known types of the parameters and locals of a function, from
+        parameter annotations and the values assigned"""
+        search = TypeSearch(self)
+        for a in node.args.args:
+            annotation = getattr(a, 'annotation', None)
+            name = getattr(a, 'arg', None) or getattr(a, 'id', None)
+            if isinstance(annotation, ast.Name) and \
+                    annotation.id in ('list', 'tuple', 'dict', 'str'):
+                search.assign(name, annotation.id)
+            else:
+                search.assign(name, None)
+        for c in node.body:
+            search.visit(c)
+        return dict((k, v) for k, v in search.types.items() if v)
+
+    def type_of(self, node, types=None):
+        """Type of an expression where it is known at compile time, one of
+        `list`, `tuple`, `dict` or `str`. Names are looked up in `types`
+        when given, e.g. the types being inferred for a function."""
+        if isinstance(node, ast.List):
+            return 'list'
+        elif isinstance(node, ast.Tuple):
+            return 'tuple'
+        elif isinstance(node, ast.Dict):
+            return 'dict'
+        elif isinstance(node, ast.Str):
+            return 'str'
+        elif isinstance(node, ast.Name):
+            # Not yet visited nodes take the types of the node being visited
+            if types is None:
+                types = getattr(node, 'types', None)
+            if types is None:
+                types = getattr(self.node_chain[-1], 'types', None)
+            return (types or {}).get(node.id)
+        elif isinstance(node, ast.Call) and \
+                isinstance(node.func, ast.Name) and \
+                node.func.id in ('list', 'tuple') and \
+                self.lookup(node.func.id) == node.func.id:
+            return node.func.id
+        return None
+
+    def has_attribute(self, type_name, attr):
+        """Whether every instance of a runtime type has `attr`"""
+        if type_name not in ('list', 'tuple'):
+            return False
+        return self.resolve('attribute', '{0}.{1}'.format(type_name, attr))
+
+    def _has_attribute(self, type_name, attr):
+        types = self.environment().types
+        return any(attr in vars(c) for c in
+                   inspect.getmro(getattr(types, type_name))
+                   if c.__module__ == types.__name__)
+
     def safe_name(self, name):
         if name in JSCompiler.KEYWORDS:
             return name + '_'
@@ -177,7 +410,7 @@ class JSCompiler(ast.NodeVisitor):
         if not node.branch:
             raise SyntaxError('Return statement not inside a function block')
 
-        tpl = ['$ctx.end = true;']
+        tpl = [] if node.straight else ['$ctx.end = true;']
         value = self.visit(node.value) if node.value else None
         if value is not None:
             extend(tpl, 'return {0};', value)
@@ -192,12 +425,18 @@ class JSCompiler(ast.NodeVisitor):
         local = ', '.join(['{0}: {0}'.format(a) for a in args])
         args = ', '.join(args)
         node.name = self.safe_name(node.name)
+        node.types = self.infer_types(node)
 
-        if node.context:
+        if node.context and not isinstance(node.context, Locals):
             assign = '{0}.{1}'.format(node.context, node.name)
         else:
             assign = 'var {0}'.format(node.name)
 
+        if self.straight_line and not node.auto_yield and \
+                not needs_state(node):
+            return self.visit_StraightFunctionDef(node, assign, args)
+
+        node.straight = False
         tpl = [
             '{0} = function {1}({2}) {{'.format(assign, node.name, args),
             '  var $exception;',
@@ -230,10 +469,31 @@ class JSCompiler(ast.NodeVisitor):
         extend(tpl, '};')
         return tpl
 
+    def visit_StraightFunctionDef(self, node, assign, args):
+        """Function compiled to plain Javascript, with locals held in
+        variables and native control flow, as it never has to resume"""
+        node.straight = True
+        node.branch = BranchPoint()
+        node.loop_point = node.break_point = None
+
+        search = LocalSearch()
+        for c in node.body:
+            search.visit(c)
+        params = [self.visit(a, inherit=False) for a in node.args.args]
+        local = [self.safe_name(n) for n in search.names
+                 if self.safe_name(n) not in params]
+
+        tpl = ['{0} = function {1}({2}) {{'.format(assign, node.name, args)]
+        if local:
+            extend(tpl, indent('var {0};'.format(', '.join(local))))
+        for c in node.body:
+            extend(tpl, indent(self.visit(c, LOCALS)))
+        if not isinstance(node.body[-1], ast.Return):
+            extend(tpl, '  return null;')
+        return extend(tpl, '};')
+
     #ClassDef(identifier name, expr* bases, stmt* body, expr* decorator_list)
     def visit_ClassDef(self, node):
-        from .. import client
-
         if len(node.bases) > 1:
             raise NotImplementedError('Multiple inheritance not supported')
 
@@ -241,7 +501,7 @@ class JSCompiler(ast.NodeVisitor):
         if node.bases:
             if isinstance(node.bases[0], ast.Attribute):
                 scope_name = node.bases[0].attr
-                scope = client._scopes.get(scope_name, None)
+                scope = self.resolve('scope', scope_name)
                 if scope:
                     return self.visit_ClientScope(node, scope)
 
@@ -358,8 +618,9 @@ class JSCompiler(ast.NodeVisitor):
                 '  schedule(methods.{0}.apply(undefined, arguments));',
                 '};',
 
-                # Events
-                '$element.on("{1}", "{2}", function eventHandler(e) {{',
+                # Events, dispatched by a delegated listener at the root
+                'delegate($element, "{1}", "{2}", '
+                'function eventHandler(e) {{',
                 '  var t = angular.element(e.target).scope();',
                 '  $scope.$apply(function() {{ $scope.{3}($scope, t, e) }});',
                 '}});'
@@ -367,7 +628,7 @@ class JSCompiler(ast.NodeVisitor):
 
         extend(tpl, indent([
             '$scope.$on("$destroy", function() {',
-            '  $element.off();',
+            '  undelegate($element);',
             '});'
         ]))
 
@@ -418,7 +679,7 @@ class JSCompiler(ast.NodeVisitor):
 
                     t = self.visit(t)
                     if not node.context:
-                        tpl.append('var {0};')
+                        tpl.append('var {0};'.format(t))
                     tpl.append('{0} = $assign[{1}];'.format(t, i))
             else:
                 if (isinstance(target, ast.Attribute) or
@@ -428,7 +689,7 @@ class JSCompiler(ast.NodeVisitor):
 
                 target = self.visit(target)
                 if not node.context:
-                    tpl.append('var {0};')
+                    tpl.append('var {0};'.format(target))
                 tpl.append('{0} = $assign;'.format(target))
 
         return tpl
@@ -454,29 +715,25 @@ class JSCompiler(ast.NodeVisitor):
         if not node.branch:
             raise SyntaxError('For statement not inside a function block')
 
-        tpl = []
-        node.loop_point = loop_point = node.branch.create()
-        node.break_point = break_point = node.branch.create()
-        try_except_point = node.branch.create()
-        try_continue_point = node.branch.create()
+        loop_point = node.branch.create()
+        break_point = node.branch.create()
+        init, test, advance, length = self.loop_header(node, loop_point)
 
-        target_node = ast.Name('iter', None)
-        assign_node = ast.Assign([target_node], node.iter)
-        assign_node.context = '$ctx.local'
-        extend(tpl, self.visit(assign_node))
+        if node.straight:
+            node.loop_point = node.break_point = True
+            tpl = extend(init, 'while ({0}) {{'.format(test))
+            extend(tpl, indent(advance))
+            for c in node.body:
+                extend(tpl, indent(self.visit(c)))
+            return extend(tpl, '}')
 
-        extend(tpl, [
+        node.loop_point = loop_point
+        node.break_point = break_point
+        tpl = extend(init, [
             label(loop_point),
-            '$ctx.try_stack.push({0});'.format(try_except_point),
-            '{0} = $ctx.local.iter.next();'.format(self.visit(node.target)),
-            '$ctx.try_stack.pop();',
-            goto(try_continue_point),
-            label(try_except_point),
-            'if ($exception instanceof StopIteration) {0};'.format(
-                goto(break_point)),
-            'throw $exception;',
-            label(try_continue_point)
+            'if (!({0})) {1};'.format(test, goto(break_point))
         ])
+        extend(tpl, advance)
 
         for c in node.body:
             extend(tpl, self.visit(c, '$ctx.local'))
@@ -487,6 +744,89 @@ class JSCompiler(ast.NodeVisitor):
         ])
         return tpl
 
+    def loop_header(self, node, n, names=None):
+        """Initialisation, test and advance to the next item of a for loop,
+        and the number of items where known in advance. Ranges and arrays
+        are walked by index, other iterables through the `step` method of
+        `iter`, which returns a sentinel when exhausted instead of raising
+        StopIteration. Temporaries are declared in place, or collected in
+        `names` when given."""
+        def var(name):
+            name = '${0}{1}'.format(name, n)
+            if names is not None:
+                names.append(name)
+            elif not node.straight:
+                name = '$ctx.local.' + name
+            return name
+        declare = 'var ' if node.straight and names is None else ''
+
+        iterable = node.iter
+        type_name = self.type_of(iterable)
+        if isinstance(iterable, ast.Call) and \
+                isinstance(iterable.func, ast.Name) and \
+                iterable.func.id == 'range' and \
+                1 <= len(iterable.args) <= 3 and \
+                not iterable.keywords and \
+                not getattr(iterable, 'starargs', None) and \
+                not getattr(iterable, 'kwargs', None) and \
+                self.lookup('range') == 'range':
+            i, end = var('i'), var('end')
+            args = [self.visit(a) for a in iterable.args]
+            if len(args) == 1:
+                args.insert(0, '0')
+            init = ['{0}{1} = {2};'.format(declare, i, args[0]),
+                    '{0}{1} = {2};'.format(declare, end, args[1])]
+
+            increment = number(iterable.args[2]) if len(args) == 3 else 1
+            if increment is None:
+                step = var('step')
+                extend(init, '{0}{1} = {2};', declare, step, args[2])
+                test = '{0} > 0 ? {1} < {2} : {1} > {2}'.format(step, i, end)
+            else:
+                step = str(increment)
+                test = '{0} {1} {2}'.format(i, '<' if increment > 0 else '>',
+                                            end)
+            value, after = i, '{0} += {1};'.format(i, step)
+            length = 'Math.max(0, Math.ceil(({0} - {1}) / {2}))'.format(
+                end, i, step)
+        elif isinstance(iterable, (ast.List, ast.Tuple)) or type_name:
+            items, i = var('items'), var('i')
+            if isinstance(iterable, (ast.List, ast.Tuple)):
+                array = '[{0}]'.format(
+                    ', '.join([self.visit(c) for c in iterable.elts]))
+            elif type_name == 'dict':
+                array = 'Object.keys({0})'.format(self.visit(iterable))
+            elif type_name == 'str':
+                array = self.visit(iterable)
+            else:
+                array = '{0}.array'.format(self.visit(iterable))
+            init = ['{0}{1} = {2};'.format(declare, items, array),
+                    '{0}{1} = 0;'.format(declare, i)]
+            test = '{0} < {1}.length'.format(i, items)
+            value, after = '{0}[{1}++]'.format(items, i), None
+            length = '{0}.length'.format(items)
+        else:
+            iterator, value = var('iter'), var('v')
+            init = ['{0}{1} = {2}({3});'.format(
+                declare, iterator, self.lookup('iter'),
+                self.visit(iterable))]
+            if declare:
+                extend(init, 'var {0};', value)
+            test = '({0} = {1}.step({2})) !== {2}'.format(
+                value, iterator, self.lookup('StopIteration'))
+            after = length = None
+
+        # Assign the item to the loop target
+        if isinstance(node.target, ast.Name):
+            advance = ['{0} = {1};'.format(self.visit(node.target), value)]
+        else:
+            advance = extend([], self.visit(
+                ast.Assign([node.target], Raw(code=value))))
+
+        if after:
+            extend(advance, after)
+        return init, test, advance, length
+
     # While(expr test, stmt* body, stmt* orelse)
     def visit_While(self, node):
         if node.orelse:
@@ -494,6 +834,13 @@ class JSCompiler(ast.NodeVisitor):
         if not node.branch:
             raise SyntaxError('While statement not inside a function block')
 
+        if node.straight:
+            node.loop_point = node.break_point = True
+            tpl = ['while (bool({0})) {{'.format(self.visit(node.test))]
+            for c in node.body:
+                extend(tpl, indent(self.visit(c)))
+            return extend(tpl, '}')
+
         tpl = []
         node.loop_point = loop_point = node.branch.create()
         node.break_point = break_point = node.branch.create()
@@ -523,6 +870,16 @@ class JSCompiler(ast.NodeVisitor):
         if not node.branch:
             raise SyntaxError('If block not inside a function block')
 
+        if node.straight:
+            tpl = ['if (bool({0})) {{'.format(self.visit(node.test))]
+            for c in node.body:
+                extend(tpl, indent(self.visit(c)))
+            if node.orelse:
+                extend(tpl, '} else {')
+                for c in node.orelse:
+                    extend(tpl, indent(self.visit(c)))
+            return extend(tpl, '}')
+
         else_point = node.branch.create()
         continue_point = node.branch.create()
         tpl = [
@@ -603,12 +960,16 @@ class JSCompiler(ast.NodeVisitor):
     def visit_Break(self, node):
         if not node.break_point:
             raise SyntaxError('Break not inside a loop block')
+        if node.straight:
+            return 'break;'
         return goto(node.break_point)
 
     # Continue
     def visit_Continue(self, node):
         if not node.loop_point:
             raise SyntaxError('Continue not inside a loop block')
+        if node.straight:
+            return 'continue;'
         return goto(node.loop_point)
 
     # BoolOp(boolop op, expr* values)
@@ -650,7 +1011,12 @@ class JSCompiler(ast.NodeVisitor):
             '$ctx.result = {0};'.format(value),
             '$ctx.next_state = {0};'.format(yield_point),
             'return $ctx;',
-            label(yield_point)
+            label(yield_point),
+            'if ($ctx.error !== undefined) {',
+            '  $exception = $ctx.error;',
+            '  delete $ctx.error;',
+            '  throw $exception;',
+            '}'
         ]
 
     #Compare(expr left, cmpop* ops, expr* comparators)
@@ -677,7 +1043,7 @@ class JSCompiler(ast.NodeVisitor):
         else:
             func_context = 'undefined'
 
-        if getattr(self.module, func, None) is JSCode:
+        if self.resolve('jscode', func):
             if isinstance(node.args[0], ast.List):
                 return '\n'.join([c.s for c in node.args[0].elts])
             elif isinstance(node.args[0], ast.Str):
@@ -689,8 +1055,15 @@ class JSCompiler(ast.NodeVisitor):
             node.values = node.args
             return self.visit_Print(node)
 
-        args = ', '.join([self.visit(a) for a in node.args])
-        return '{0}.apply({1}, [{2}])'.format(func, func_context, args)
+        # Functions called without a context, and methods the type of the
+        # object is known to have, are called directly
+        args = [self.visit(a) for a in node.args]
+        if not isinstance(node.func, ast.Attribute) or \
+                self.resolve('jscode', func_context) or \
+                self.has_attribute(self.type_of(node.func.value),
+                                   node.func.attr):
+            return '{0}({1})'.format(func, ', '.join(args))
+        return '{0}.call({1})'.format(func, ', '.join([func_context] + args))
 
     # Num(object n)
     def visit_Num(self, node):
@@ -704,10 +1077,13 @@ class JSCompiler(ast.NodeVisitor):
     def visit_Attribute(self, node, options):
         obj = self.visit(node.value)
         attr = node.attr
-        if getattr(self.module, obj, None) is JSCode:
+        if self.resolve('jscode', obj):
             return attr
         if options.get or isinstance(node.ctx, ast.Load):
-            return 'getattr({0}, "{1}")'.format(obj, attr)
+            if self.has_attribute(self.type_of(node.value), attr):
+                return '{0}.{1}'.format(obj, self.safe_name(attr))
+            # Methods named after keywords are defined with safe names
+            return 'getattr({0}, "{1}")'.format(obj, self.safe_name(attr))
         elif isinstance(node.ctx, ast.Store):
             return 'setattr({0}, "{1}", {2})'.format(obj, attr, options.value)
         else:
@@ -717,9 +1093,24 @@ class JSCompiler(ast.NodeVisitor):
     def visit_Subscript(self, node, options):
         obj = self.visit(node.value)
         index = self.visit(node.slice)
+
+        # Index the underlying Javascript array or object directly when the
+        # type of the object is known
+        type_name = None
+        if isinstance(node.slice, ast.Index):
+            type_name = self.type_of(node.value)
+        if type_name in ('list', 'tuple'):
+            items = '{0}.array'.format(obj)
+        else:
+            items = obj
+
         if options.get or isinstance(node.ctx, ast.Load):
+            if type_name:
+                return '{0}[{1}]'.format(items, index)
             return 'getitem({0}, {1})'.format(obj, index)
         elif isinstance(node.ctx, ast.Store):
+            if type_name in ('list', 'dict'):
+                return '{0}[{1}] = {2}'.format(items, index, options.value)
             return 'setitem({0}, {1}, {2})'.format(obj, index, options.value)
         else:
             raise SyntaxError('Invaid ctx for subscript')
@@ -730,7 +1121,14 @@ class JSCompiler(ast.NodeVisitor):
         if lookup:
             return lookup
         name = self.safe_name(node.id)
-        return '{0}.{1}'.format(node.context, name) if node.context else name
+        context = node.context
+        while isinstance(context, Comprehension):
+            if name in context.names:
+                return name
+            context = context.parent
+        if isinstance(context, Locals):
+            return name
+        return '{0}.{1}'.format(context, name) if context else name
 
     # List(expr* elts, expr_context ctx)
     def visit_List(self, node):
@@ -742,6 +1140,141 @@ class JSCompiler(ast.NodeVisitor):
         return 'tuple([{0}])'.format(
             ', '.join([self.visit(c) for c in node.elts]))
 
+    # ListComp(expr elt, comprehension* generators)
+    def visit_ListComp(self, node):
+        return self.visit_Comprehension(
+            node, [node.elt], '$r[$n++] = {0};', '$r.push({0});',
+            '{0}($r)'.format(self.lookup('list')))
+
+    # SetComp(expr elt, comprehension* generators)
+    def visit_SetComp(self, node):
+        # No set type in the runtime, sets are lists of distinct items
+        return self.visit_Comprehension(
+            node, [node.elt], None,
+            'var $item = {0}; if ($r.indexOf($item) < 0) $r.push($item);',
+            '{0}($r)'.format(self.lookup('list')))
+
+    # DictComp(expr key, expr value, comprehension* generators)
+    def visit_DictComp(self, node):
+        return self.visit_Comprehension(
+            node, [node.key, node.value], None, '$r[{0}] = {1};', '$r',
+            initial='{}')
+
+    def visit_Comprehension(self, node, elts, preallocated, store, result,
+                            initial='[]'):
+        """Comprehension as a function called in place, with its targets as
+        its own locals, filling `$r` from native loops. Lists are
+        preallocated when the number of items is known in advance."""
+        node.auto_yield = False
+        names = self.comprehension_names(node)
+        node.context = Comprehension(names, node.context)
+
+        tpl = []
+        depth = 0
+        for g in node.generators:
+            loop = ast.For(target=g.target, iter=g.iter, body=[], orelse=[])
+            loop.straight = True
+            self.loop_count += 1
+            init, test, advance, length = self.loop_header(
+                loop, 'c{0}'.format(self.loop_count))
+            extend(tpl, indent(init, level=depth))
+
+            if len(node.generators) > 1 or g.ifs:
+                preallocated = None
+            if preallocated and length:
+                extend(tpl, indent([
+                    'var $r = new Array({0});'.format(length),
+                    'var $n = 0;'
+                ], level=depth))
+                store = preallocated
+
+            extend(tpl, indent('while ({0}) {{'.format(test), level=depth))
+            depth += 1
+            extend(tpl, indent(advance, level=depth))
+            for c in g.ifs:
+                extend(tpl, indent('if (!bool({0})) continue;'.format(
+                    self.visit(c)), level=depth))
+
+        extend(tpl, indent(
+            store.format(*[self.visit(e) for e in elts]), level=depth))
+        for i in range(depth):
+            extend(tpl, indent('}', level=depth - i - 1))
+
+        if store != preallocated:
+            tpl.insert(0, 'var $r = {0};'.format(initial))
+        if names:
+            tpl.insert(0, 'var {0};'.format(', '.join(names)))
+        return '\n'.join(['(function() {'] + indent(tpl) + [
+            '  return {0};'.format(result),
+            '}).call(this)'
+        ])
+
+    # GeneratorExp(expr elt, comprehension* generators)
+    def visit_GeneratorExp(self, node):
+        """Lazy iterator, its `step` resumes the nested loops where the last
+        item was produced, tracking the innermost running loop in `$d`"""
+        node.auto_yield = False
+        names = self.comprehension_names(node)
+        node.context = Comprehension(names, node.context)
+
+        temps = []
+        tpl = []
+        for d, g in enumerate(node.generators):
+            loop = ast.For(target=g.target, iter=g.iter, body=[], orelse=[])
+            loop.straight = True
+            self.loop_count += 1
+            init, test, advance, length = self.loop_header(
+                loop, 'c{0}'.format(self.loop_count), temps)
+
+            if d == 0:
+                head = init
+                exhausted = 'return $done;'
+            else:
+                extend(tpl, indent(init, level=3))
+                extend(tpl, indent('$d = {0};'.format(d + 1), level=3))
+                extend(tpl, '    }')
+                exhausted = '{{ $d = {0}; continue; }}'.format(d)
+
+            extend(tpl, '    if ($d === {0}) {{'.format(d + 1))
+            extend(tpl, indent('if (!({0})) {1}'.format(test, exhausted),
+                               level=3))
+            extend(tpl, indent(advance, level=3))
+            for c in g.ifs:
+                extend(tpl, indent('if (!bool({0})) continue;'.format(
+                    self.visit(c)), level=3))
+
+        extend(tpl, [
+            '      return {0};'.format(self.visit(node.elt)),
+            '    }'
+        ])
+
+        declare = ['var $d = 1;']
+        if names or temps:
+            declare.insert(0, 'var {0};'.format(', '.join(names + temps)))
+        return '\n'.join(['(function() {'] + indent(declare + head) + [
+            '  return {step: function step($done) {',
+            '    while (true) {'
+        ] + tpl + [
+            '    }',
+            '  }};',
+            '}).call(this)'
+        ])
+
+    def comprehension_names(self, node):
+        """Names assigned by the targets of a comprehension"""
+        names = []
+        for g in node.generators:
+            for n in ast.walk(g.target):
+                if isinstance(n, ast.Name):
+                    name = self.safe_name(n.id)
+                    if name not in names:
+                        names.append(name)
+        return names
+
+    # Raw(string code)
+    def visit_Raw(self, node):
+        return node.code
+
     # Index(expr value)
     def visit_Index(self, node):
         return self.visit(node.value)
@@ -805,6 +1338,16 @@ def extend(template, lines, *format_params):
     return template
 
 
+def number(node):
+    """Value of a numeric literal, None if `node` is not one"""
+    if isinstance(node, ast.Num):
+        return node.n
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and \
+            isinstance(node.operand, ast.Num):
+        return -node.operand.n
+    return None
+
+
 def goto(point, state='$ctx.next_state'):
     return '{{ {0} = {1}; continue; }}'.format(state, point)
 
@@ -824,13 +1367,148 @@ def is_generator(node):
     return searcher.found_yield
 
 
-def js_compile(obj):
+def needs_state(node):
+    """Whether a function has to be compiled to a resumable state machine"""
+    searcher = StateSearch()
+    searcher.found_state = False
+    for c in node.body:
+        searcher.visit(c)
+    return searcher.found_state
+
+
+def js_compile(obj, cached_only=False):
     if not getattr(obj, '__js__', None):
-        node = ast.parse(inspect.getsource(obj))
-        obj.__js__ = JSCompiler(obj).visit(node)
+        source = inspect.getsource(obj)
+        name = '{0}.{1}'.format(getattr(obj, '__module__', None),
+                                obj.__name__)
+        key = cache.key(VERSION, name, source)
+        compiler = JSCompiler(obj)
+
+        entry = cache.get(key)
+        if entry and compiler.resolves(entry['dependencies']):
+            obj.__js__ = entry['js']
+        elif cached_only:
+            return None
+        else:
+            obj.__js__ = compiler.visit(ast.parse(source))
+            cache.put(key, {
+                'js': obj.__js__,
+                'dependencies': compiler.dependencies
+            })
     return obj.__js__
 
 
-def runtime():
+def runtime_units(module, cached_only=False):
+    """Compile the top level definitions of a runtime module separately, as
+    `[name, js]` pairs in definition order. Other statements belong to the
+    definition they refer to, e.g. `object.oid = 0` to `object`."""
+    if getattr(module, '__js_units__', None) is None:
+        source = inspect.getsource(module)
+        key = cache.key(VERSION, module.__name__ + ':units', source)
+        compiler = JSCompiler(module)
+
+        entry = cache.get(key)
+        if entry and compiler.resolves(entry['dependencies']):
+            module.__js_units__ = entry['units']
+        elif cached_only:
+            return None
+        else:
+            units = []
+            for node in ast.parse(source).body:
+                if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                    name = node.name
+                elif isinstance(node, ast.Expr) and \
+                        isinstance(node.value, ast.Str):
+                    continue
+                else:
+                    names = [n.id for n in ast.walk(node)
+                             if isinstance(n, ast.Name)]
+                    name = next((u[0] for u in units if u[0] in names), None)
+
+                js = '\n'.join(extend([], compiler.visit(node)))
+                if not js:
+                    continue
+                elif units and name is not None and units[-1][0] == name:
+                    units[-1][1] += '\n' + js
+                else:
+                    units.append([name, js])
+
+            module.__js_units__ = units
+            cache.put(key, {
+                'units': units,
+                'dependencies': compiler.dependencies
+            })
+    return module.__js_units__
+
+
+def runtime_modules():
     from . import builtins, types, exceptions
-    return js_compile(builtins) + js_compile(types) + js_compile(exceptions)
+    return [builtins, types, exceptions]
+
+
+def _compile(obj, cached_only=False):
+    if isinstance(obj, ModuleType):
+        return runtime_units(obj, cached_only)
+    return js_compile(obj, cached_only)
+
+
+def _compile_pooled(i):
+    return _compile(_pool_objs[i])
+
+
+def compile_all(objs, workers=1):
+    """Compile runtime modules and client functions, in order. Those not in
+    the compile cache are compiled by a pool of `workers` processes, which
+    needs `fork` so workers start with the same modules imported."""
+    global _pool_objs
+
+    objs = list(objs)
+    pending = [i for i, obj in enumerate(objs)
+               if _compile(obj, cached_only=True) is None]
+
+    if workers > 1 and len(pending) > 1 and hasattr(os, 'fork'):
+        _pool_objs = objs
+        pool = multiprocessing.Pool(min(workers, len(pending)))
+        try:
+            results = pool.map(_compile_pooled, pending)
+        finally:
+            pool.close()
+            pool.join()
+            _pool_objs = None
+
+        for i, result in zip(pending, results):
+            if isinstance(objs[i], ModuleType):
+                objs[i].__js_units__ = result
+            else:
+                objs[i].__js__ = result
+
+    return [_compile(obj) for obj in objs]
+
+
+def runtime(roots=None, minified=False):
+    """Compiled runtime. Given `roots`, the Javascript using the runtime,
+    only the definitions it refers to, directly or through other
+    definitions, are included."""
+    from . import minify
+
+    units = []
+    for module in runtime_modules():
+        units.extend(runtime_units(module))
+
+    if roots is not None:
+        # Definitions are split by name, a name defined again joins them
+        references = {}
+        for name, js in units:
+            references.setdefault(name, set()).update(minify.references(js))
+
+        used = set([None])
+        pending = list(minify.references('\n'.join(roots)))
+        while pending:
+            name = pending.pop()
+            if name in references and name not in used:
+                used.add(name)
+                pending.extend(references[name])
+        units = [u for u in units if u[0] in used]
+
+    js = '\n'.join(u[1] for u in units)
+    return minify.minify(js) if minified else js
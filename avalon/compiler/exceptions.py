@@ -39,3 +39,11 @@ class TypeError(Exception):
 
 class AttributeError(Exception):
     pass
+
+
+class RPCError(Exception):
+    pass
+
+
+class Timeout(RPCError):
+    pass
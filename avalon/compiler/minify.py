@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Whitespace removal and identifier shortening for compiled Javascript
+"""
+
+import re
+
+_TOKEN = re.compile(r'''
+    (?P<space>[ \t\r\f\v]+)
+  | (?P<newline>\n)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<name>[A-Za-z_$][\w$]*)
+  | (?P<number>\.?\d[\w.]*)
+  | (?P<punct>>>>=?|===|!==|<<=|>>=|\+\+|--|&&|\|\||<<|>>|[-+*/%&|^!=<>]=|.)
+''', re.X | re.S)
+
+# Tokens after which a `/` starts a regular expression, not a division
+_REGEX_KEYWORDS = ['case', 'delete', 'do', 'else', 'in', 'instanceof', 'new',
+                   'return', 'throw', 'typeof', 'void']
+_NOT_REGEX_PUNCT = [')', ']', '}', '++', '--']
+
+# Names the compiler generates, which never escape the code it emits
+_INTERNAL = re.compile(r'^\$(ctx|assign|exception|iter\d+)$')
+_SHORT = {'ctx': '$c', 'assign': '$a', 'exception': '$x'}
+
+_WORD = re.compile(r'[\w$]')
+
+# No newline is needed after these, automatic semicolon insertion never
+# applies
+_CONTINUED = ';{,(['
+
+
+def _regex_end(js, pos):
+    in_class = False
+    i = pos + 1
+    while i < len(js):
+        c = js[i]
+        if c == '\n':
+            return None
+        elif c == '\\':
+            i += 1
+        elif c == '[':
+            in_class = True
+        elif c == ']':
+            in_class = False
+        elif c == '/' and not in_class:
+            i += 1
+            while i < len(js) and _WORD.match(js[i]):
+                i += 1
+            return i
+        i += 1
+    return None
+
+
+def tokenize(js):
+    """Split Javascript into `(kind, text)` tokens"""
+    pos, last = 0, None
+    while pos < len(js):
+        m = _TOKEN.match(js, pos)
+        kind, text = m.lastgroup, m.group()
+        if kind == 'punct' and text == '/' and (
+                last is None or
+                (last[0] == 'punct' and last[1] not in _NOT_REGEX_PUNCT) or
+                (last[0] == 'name' and last[1] in _REGEX_KEYWORDS)):
+            end = _regex_end(js, pos)
+            if end:
+                kind, text = 'regex', js[pos:end]
+        pos += len(text)
+        if kind not in ('space', 'newline', 'comment'):
+            last = (kind, text)
+        yield kind, text
+
+
+def references(js):
+    """Names used as variables in Javascript, excluding property names"""
+    names = set()
+    last = None
+    for kind, text in tokenize(js):
+        if kind == 'name' and last != '.':
+            names.add(text)
+        if kind not in ('space', 'newline', 'comment'):
+            last = text
+    return names
+
+
+def short_names(js):
+    """Shorter names for the compiler generated variables in `js`"""
+    used = references(js)
+    names = {}
+    for name in sorted(used):
+        m = _INTERNAL.match(name)
+        if not m:
+            continue
+        short = _SHORT.get(m.group(1), '$' + m.group(1)[len('iter'):])
+        if short not in used:
+            names[name] = short
+    return names
+
+
+def minify(js):
+    """Remove comments and whitespace not needed to parse `js`, and shorten
+    the names of compiler generated variables"""
+    names = short_names(js)
+    out = []
+    last = None
+    newline = False
+    for kind, text in tokenize(js):
+        if kind == 'space':
+            continue
+        elif kind == 'newline' or (kind == 'comment' and '\n' in text):
+            newline = True
+            continue
+        elif kind == 'comment':
+            continue
+
+        if kind == 'name' and last != '.':
+            text = names.get(text, text)
+
+        if out:
+            prev = out[-1][-1]
+            if newline and prev not in _CONTINUED:
+                out.append('\n')
+            elif ((_WORD.match(prev) and _WORD.match(text[0])) or
+                    (prev in '+-' and text[0] == prev)):
+                out.append(' ')
+
+        out.append(text)
+        last = text
+        newline = False
+    return ''.join(out)
@@ -45,8 +45,8 @@ class array(object):
         raise TypeError("unhashable type: '" + self.__class__.__name__ + "'")
 
     def __iter__(self):
-        for i in range(self.array.length):
-            yield JSCode('this.array[$ctx.local.i]')
+        for i in self.array:
+            yield i
 
     def __len__(self):
         return JSCode('this.array.length')
@@ -81,8 +81,16 @@ class generator(object):
             raise StopIteration(ret)
         return self.ctx['result']
 
-    def throw(self):
-        raise NotImplemented()
+    def step(self, done):
+        self.ctx['send'] = None
+        self.ctx['func'].call(self.ctx['ctx'], self.ctx)
+        if self.ctx['end']:
+            return done
+        return self.ctx['result']
+
+    def throw(self, error):
+        self.ctx['error'] = error
+        return self.send(None)
 
     def close(self):
         raise NotImplemented()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Subscription fanout policies
+"""
+
+from collections import OrderedDict
+from tornado.ioloop import IOLoop
+
+
+class Immediate(object):
+    """Send every change as soon as it arrives"""
+
+    def __init__(self):
+        self.flush_callback = None
+        self.buffer = OrderedDict()
+
+    def bind(self, flush_callback):
+        self.flush_callback = flush_callback
+        return self
+
+    def push(self, key, item):
+        if key is None:
+            key = object()
+        elif key in self.buffer:
+            # Merge successive changes, keeping the latest in arrival order
+            del self.buffer[key]
+        self.buffer[key] = item
+        self.schedule()
+
+    def schedule(self):
+        self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        items = list(self.buffer.values())
+        self.buffer.clear()
+        self.flush_callback(items)
+
+    def close(self):
+        self.buffer.clear()
+
+
+class Debounce(Immediate):
+    """Send changes once no change has arrived for `delay` ms, or at most
+    `max_delay` ms after the first buffered change"""
+
+    def __init__(self, delay, max_delay=None):
+        super(Debounce, self).__init__()
+        self.delay = delay / 1000.0
+        self.max_delay = max_delay and max_delay / 1000.0
+        self.timeout = None
+        self.first = None
+
+    def schedule(self):
+        io_loop = IOLoop.instance()
+        now = io_loop.time()
+
+        if self.timeout:
+            io_loop.remove_timeout(self.timeout)
+        else:
+            self.first = now
+
+        deadline = now + self.delay
+        if self.max_delay:
+            deadline = min(deadline, self.first + self.max_delay)
+        self.timeout = io_loop.add_timeout(deadline, self.flush)
+
+    def flush(self):
+        if self.timeout:
+            IOLoop.instance().remove_timeout(self.timeout)
+        self.timeout = None
+        super(Debounce, self).flush()
+
+    def close(self):
+        if self.timeout:
+            IOLoop.instance().remove_timeout(self.timeout)
+        self.timeout = None
+        super(Debounce, self).close()
+
+
+class Rate(Immediate):
+    """Send at most `rate` messages per second"""
+
+    def __init__(self, rate):
+        super(Rate, self).__init__()
+        self.interval = 1.0 / rate
+        self.timeout = None
+        self.last = 0
+
+    def schedule(self):
+        if self.timeout:
+            return
+
+        io_loop = IOLoop.instance()
+        deadline = self.last + self.interval
+        if deadline <= io_loop.time():
+            self.flush()
+            return
+        self.timeout = io_loop.add_timeout(deadline, self.flush)
+
+    def flush(self):
+        if self.timeout:
+            IOLoop.instance().remove_timeout(self.timeout)
+        self.timeout = None
+        self.last = IOLoop.instance().time()
+        super(Rate, self).flush()
+
+    def close(self):
+        if self.timeout:
+            IOLoop.instance().remove_timeout(self.timeout)
+        self.timeout = None
+        super(Rate, self).close()
+
+
+def create(policy=None):
+    """Create a fanout from a policy spec, e.g. `{'debounce': 100}`,
+    `{'debounce': 100, 'max_delay': 500}` or `{'rate': 10}`"""
+
+    policy = policy or {}
+    if policy.get('debounce'):
+        return Debounce(policy['debounce'], policy.get('max_delay'))
+    elif policy.get('rate'):
+        return Rate(policy['rate'])
+    return Immediate()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Process metrics
+"""
+
+_metrics = {}
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge(object):
+    def __init__(self, func=None):
+        self.func = func
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self.func() if self.func else self._value
+
+
+class Timer(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def value(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max
+        }
+
+
+def counter(name):
+    return _metrics.setdefault(name, Counter())
+
+
+def gauge(name, func=None):
+    metric = _metrics.setdefault(name, Gauge(func))
+    if func:
+        metric.func = func
+    return metric
+
+
+def timer(name):
+    return _metrics.setdefault(name, Timer())
+
+
+def snapshot():
+    return {name: m.value for name, m in _metrics.items()}
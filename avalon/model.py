@@ -5,16 +5,35 @@
 #==============================================================================
 
 import greenlet
+import re
+import time
 
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_left, bisect_right, insort
 from bson import ObjectId, json_util as json
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
 from greenlet import greenlet as Greenlet
-from motor import MotorClient
+from numbers import Number
+from weakref import WeakSet
+from motor import MotorClient, MotorPool, MotorReplicaSetClient
 from pymongo import uri_parser
 from pymongo.errors import CollectionInvalid, ConfigurationError
-from tornado.ioloop import PeriodicCallback
+from pymongo.read_preferences import ReadPreference
+from six import string_types, with_metaclass
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
 
-from . import _log
+from . import fanout, metrics, _log
+from .query import compare, field, match, sort_key, value_key
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    StopAsyncIteration = StopIteration
 
 
 class Store(object):
@@ -24,12 +43,42 @@ class Store(object):
     def __init__(self):
         self.client = None
         self.db = None
+        self.db_sync = None
         self.subscriptions = {}
+        self.fanout_policies = {}
+        self.default_concern = {'w': 1, 'j': True}
+        self.write_concerns = {}
+        self.default_read_preference = None
+        self.snapshot_read_preference = None
+        self.read_preferences = {}
+        self.aio = AsyncStore(self)
+
+        metrics.gauge('model.subscriptions', lambda: sum(
+            len(s.requests) for s in self.subscriptions.values()))
+        metrics.gauge('model.tailers', lambda: len(self.subscriptions))
 
-    def connect(self, uri, db=None, w=1, j=True, **options):
+    def connect(self, uri, db=None, w=1, j=True, read_preference=None,
+                snapshot_read_preference=None, **options):
+        """Connect to a database. Pool options are passed to Motor, e.g.
+        `max_concurrent` (most connections open at once), `max_wait_time`
+        (seconds an operation may wait for a connection) and
+        `max_pool_size` (idle connections kept). A replica set client is
+        used when a `replicaSet` is given, so reads can be routed with
+        `read_preference` and, for subscription snapshots,
+        `snapshot_read_preference`."""
         io_loop = options.get('io_loop', None)
 
-        self.client = MotorClient(uri, w=w, j=j, **options).open_sync()
+        uri_options = uri_parser.parse_uri(uri)['options']
+        if 'replicaset' in uri_options or 'replicaSet' in options:
+            client_class = MeteredMotorReplicaSetClient
+        else:
+            client_class = MeteredMotorClient
+
+        self.client = client_class(uri, w=w, j=j, **options).open_sync()
+        self.default_concern = {'w': w, 'j': j}
+        self.default_read_preference = parse_read_preference(read_preference)
+        self.snapshot_read_preference = parse_read_preference(
+            snapshot_read_preference)
         self.client_sync = self.client.sync_client()
 
         db = db or uri_parser.parse_uri(uri)['database']
@@ -54,69 +103,144 @@ class Store(object):
 
         return self.db[collection_opslog]
 
-    def _monitor(self, collection, query_key, query):
+    def fanout(self, collection, **policy):
+        """Set the default fanout policy for subscriptions to a collection,
+        e.g. `model.fanout('cursors', rate=10)`"""
+        self.fanout_policies[collection] = policy
+
+    def write_concern(self, collection, **concern):
+        """Set the write concern policy for a collection, e.g.
+        `model.write_concern('telemetry', w=0)`. Opslog writes use the same
+        concern unless overridden with `opslog_w`/`opslog_j`, e.g.
+        `model.write_concern('events', w=1, j=True, opslog_j=False)`"""
+        self.write_concerns[collection] = concern
+
+    def read_preference(self, collection, preference):
+        """Set the read preference for a collection, e.g.
+        `model.read_preference('articles', 'secondaryPreferred')`"""
+        self.read_preferences[collection] = \
+            parse_read_preference(preference)
+
+    def read_options(self, collection, snapshot=False):
+        preferences = [self.read_preferences.get(collection)]
+        if snapshot:
+            preferences.append(self.snapshot_read_preference)
+        preferences.append(self.default_read_preference)
+
+        for preference in preferences:
+            if preference is not None:
+                return {'read_preference': preference}
+        return {}
+
+    def _monitor(self, subscription):
         # TODO: Handle doc removal
-        # TODO: Batch requests
+        collection = subscription.collection
+        cursor = None
         try:
-            query = {'doc.{0}'.format(k): v for k, v in query.items()}
-            query['_id'] = {'$gt': ObjectId.from_datetime(datetime.utcnow())}
+            query = subscription.ops_query(
+                ObjectId.from_datetime(datetime.utcnow()))
             opslog = self.opslog(collection)
+            if subscription.closed:
+                return
+
             cursor = opslog.find(query, tailable=True, await_data=True)
-            item = tail(cursor.tail)
-            while True:
-                ops, err = next(item)
+            subscription.tailer = tail(cursor.tail)
+            subscription.start()
+            for ops, err in subscription.tailer:
                 if err:
                     raise err
 
-                print(ops)
                 if not ops['doc'].get('_id'):
                     _log.warn('Opslog for collection "{0}" contains a '
                               'document with no _id'.format(collection))
                     continue
 
-                if ops['op'] == 'insert':
-                    doc = ops['doc']
-                elif ops['op'] == 'update':
-                    doc = ops['updated']
-
-                response = json.dumps({
-                    'response': 'subscribe',
-                    'query': query_key,
-                    'collection': collection,
-                    'result': [doc],
-                })
-
-                for request in list(self.subscriptions[query_key]):
-                    if request.is_closed:
-                        self.subscriptions[query_key].remove(request)
-                        continue
-                    request.send(response)
-
-                if not self.subscriptions[query_key]:
+                subscription.publish(ops)
+                if not subscription.requests:
                     break
         except Exception as e:
             _log.exception(e)
+            subscription.fail(e)
         finally:
-            if query_key in self.subscriptions:
-                del self.subscriptions[query_key]
+            if cursor:
+                cursor.close()
+            subscription.close()
+            if self.subscriptions.get(subscription.key) is subscription:
+                del self.subscriptions[subscription.key]
 
-    def subscribe(self, request, collection, query_key):
+    def subscribe(self, request, collection, query_key, since=None):
+        """Add a connection to a live query. Connections already holding a
+        preloaded result pass the opslog id it was taken at as `since`, so
+        only the changes made after it are sent."""
         # TODO: Inject security policies/adapters/transforms here
-        query = json.loads(query_key)
+        query, options = parse_query_key(query_key)
 
-        if query_key in self.subscriptions:
-            self.subscriptions[query_key].add(request)
-        else:
-            Greenlet(self._monitor).switch(collection, query_key, query)
-            self.subscriptions[query_key] = {request}
+        key = (collection, query_key)
+        subscription = self.subscriptions.get(key)
+        if not subscription:
+            policy = options.get('fanout',
+                                 self.fanout_policies.get(collection))
+            if options.get('aggregate'):
+                subscription = AggregateSubscription(
+                    self, collection, query_key, query, policy,
+                    options['aggregate'])
+            elif options.get('sort') or options.get('limit'):
+                subscription = SortedSubscription(
+                    self, collection, query_key, query, policy,
+                    options.get('sort'), options.get('limit'))
+            else:
+                subscription = Subscription(
+                    self, collection, query_key, query, policy)
+            subscription.requests.add(request)
+            self.subscriptions[key] = subscription
+            Greenlet(self._monitor).switch(subscription)
 
-        docs = defer(self.db[collection].find(query).to_list, 1000)
-        request.send(json.dumps({
-            'response': 'subscribe',
-            'query': query_key,
+        subscription.join(request, since)
+
+    def preload(self, collection, query=None, options=None):
+        """Snapshot of a live query taken synchronously, for embedding in a
+        page before the channel is open"""
+        query = query or {}
+        options = options or {}
+        assert not options.get('aggregate'), \
+            'Aggregate subscriptions cannot be preloaded'
+
+        # Taken before querying, so no change is missed when catching up
+        since = ObjectId.from_datetime(datetime.utcnow())
+        cursor = self.db_sync[collection].find(
+            query, **self.read_options(collection, snapshot=True))
+        if options.get('sort'):
+            cursor = cursor.sort([(f, d) for f, d in options['sort']] +
+                                 [('_id', 1)])
+        cursor = cursor.limit(options.get('limit') or 1000)
+
+        return {
             'collection': collection,
-            'result': docs
-        }))
+            'query': query,
+            'options': options or None,
+            'result': list(cursor),
+            'since': since
+        }
+
+    def unsubscribe(self, request, collection=None, query_key=None):
+        """Remove a connection from a subscription, or from all of its
+        subscriptions if none is given. Subscriptions left without any
+        connection stop tailing immediately."""
+        if collection is None:
+            keys = [k for k, s in self.subscriptions.items()
+                    if request in s.requests]
+        else:
+            keys = [(collection, query_key)]
+
+        for key in keys:
+            subscription = self.subscriptions.get(key)
+            if not subscription:
+                continue
+
+            subscription.leave(request)
+            if not subscription.requests:
+                del self.subscriptions[key]
+                subscription.close()
 
     def __getattr__(self, name):
         return self[name]
@@ -125,17 +249,457 @@ class Store(object):
         return Collection(model, name)
 
 
+class Subscription(object):
+    def __init__(self, store, collection, query_key, query, policy=None):
+        self.store = store
+        self.collection = collection
+        self.query_key = query_key
+        self.query = query
+        self.requests = set()
+        self.tailer = None
+        self.closed = False
+        self.fanout = fanout.create(policy).bind(self.send)
+
+    @property
+    def key(self):
+        return self.collection, self.query_key
+
+    def start(self):
+        pass
+
+    def join(self, request, since=None):
+        self.requests.add(request)
+        if since is not None:
+            docs = self.changes(since)
+        else:
+            docs = defer(self.find().to_list, 1000)
+        request.send(self.response(docs))
+
+    def leave(self, request):
+        self.requests.discard(request)
+
+    def find(self, **kwargs):
+        kwargs.update(self.store.read_options(self.collection, snapshot=True))
+        return self.store.db[self.collection].find(self.query, **kwargs)
+
+    def ops_query(self, since):
+        """Opslog query for the ops made after `since`"""
+        # Match ops on either version of a document, so documents
+        # updated into the query are seen as well
+        query = {'_id': {'$gt': since}}
+        if self.query:
+            query['$or'] = [
+                {'{0}.{1}'.format(d, k): v for k, v in self.query.items()}
+                for d in ('doc', 'updated')
+            ]
+        return query
+
+    def changes(self, since):
+        """Latest version of the documents changed after `since`"""
+        opslog = self.store.opslog(self.collection)
+        cursor = opslog.find(self.ops_query(since)).sort('$natural', 1)
+        docs = {}
+        for ops in defer(cursor.to_list, 1000):
+            if ops['op'] == 'insert':
+                docs[ops['doc']['_id']] = ops['doc']
+            elif ops['op'] == 'update':
+                docs[ops['updated']['_id']] = ops['updated']
+        return list(docs.values())
+
+    def publish(self, ops):
+        if ops['op'] == 'insert':
+            doc = ops['doc']
+        elif ops['op'] == 'update':
+            doc = ops['updated']
+        else:
+            return
+        self.fanout.push(doc['_id'], doc)
+
+    def response(self, docs):
+        return json.dumps({
+            'response': 'subscribe',
+            'query': self.query_key,
+            'collection': self.collection,
+            'result': docs,
+        })
+
+    def recipients(self):
+        for request in list(self.requests):
+            if request.is_closed:
+                self.leave(request)
+                continue
+            yield request
+
+    def send(self, docs):
+        response = self.response(docs)
+        for request in self.recipients():
+            request.send(response)
+
+    def fail(self, error):
+        """Tell subscribers the subscription failed, so they subscribe
+        again"""
+        response = json.dumps({
+            'response': 'subscribe',
+            'query': self.query_key,
+            'collection': self.collection,
+            'error': str(error) or type(error).__name__
+        })
+        for request in list(self.requests):
+            if not request.is_closed:
+                request.send(response)
+
+    def close(self):
+        self.closed = True
+        self.fanout.close()
+        if self.tailer:
+            self.tailer.stop()
+
+
+class LiveSubscription(with_metaclass(ABCMeta, Subscription)):
+    """Subscription with server side state, loaded once when tailing starts
+    and then maintained from the opslog. Ops arriving while loading are
+    queued by the tailer and applied afterwards, so the state only ever
+    changes on the monitor greenlet. New subscribers are sent a snapshot of
+    the state instead of querying the database again."""
+
+    def __init__(self, *args, **kwargs):
+        super(LiveSubscription, self).__init__(*args, **kwargs)
+        self.loaded = False
+        self.ready = set()
+
+    @abstractmethod
+    def load(self):
+        """Load the state from the database"""
+
+    @abstractmethod
+    def snapshot(self):
+        """Response sending the whole state to a new subscriber"""
+
+    def start(self):
+        self.load()
+        self.loaded = True
+        for request in list(self.requests):
+            self.join(request)
+
+    def join(self, request, since=None):
+        # The snapshot comes from memory, so it is sent whole even to
+        # connections holding a preloaded result
+        self.requests.add(request)
+        if not self.loaded or request in self.ready:
+            return
+
+        # Send buffered changes first, they are part of the snapshot already
+        self.fanout.flush()
+        request.send(self.snapshot())
+        self.ready.add(request)
+
+    def leave(self, request):
+        super(LiveSubscription, self).leave(request)
+        self.ready.discard(request)
+
+    def recipients(self):
+        for request in super(LiveSubscription, self).recipients():
+            if request in self.ready:
+                yield request
+
+
+class SortedSubscription(LiveSubscription):
+    """Live query over a bounded window of results in sort order, sending
+    only position changes: insert at, move and remove."""
+
+    def __init__(self, store, collection, query_key, query, policy=None,
+                 sort=None, limit=None):
+        super(SortedSubscription, self).__init__(
+            store, collection, query_key, query, policy)
+        self.sort = [(f, d) for f, d in sort or []] + [('_id', 1)]
+        self.limit = limit
+        self.sort_key = sort_key(sort)
+        self.keys = []
+        self.docs = []
+        self.ids = set()
+        self.complete = False
+
+    def window(self, skip=0, limit=None):
+        """Documents in sort order, all of them without a `limit`, as the
+        window is only complete when nothing past its end is left out"""
+        cursor = self.find().sort(self.sort).skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return defer(cursor.to_list, limit)
+
+    def load(self):
+        self.docs = self.window(limit=self.limit)
+        self.keys = [self.sort_key(d) for d in self.docs]
+        self.ids = set(d['_id'] for d in self.docs)
+        self.complete = not self.limit or len(self.docs) < self.limit
+
+    def snapshot(self):
+        return json.dumps({
+            'response': 'subscribe',
+            'query': self.query_key,
+            'collection': self.collection,
+            'result': self.docs,
+            'sorted': True
+        })
+
+    def position(self, doc):
+        i = bisect_left(self.keys, self.sort_key(doc))
+        if i < len(self.docs) and self.docs[i]['_id'] == doc['_id']:
+            return i
+        for i, d in enumerate(self.docs):
+            if d['_id'] == doc['_id']:
+                return i
+
+    def publish(self, ops):
+        _id = ops['doc']['_id']
+        doc = ops['updated'] if ops['op'] == 'update' else ops['doc']
+        if ops['op'] == 'remove' or not match(self.query, doc):
+            doc = None
+
+        old = None
+        if _id in self.ids:
+            old = self.position(ops['doc'])
+            del self.keys[old], self.docs[old]
+            self.ids.remove(_id)
+
+        new = None
+        if doc is not None:
+            key = self.sort_key(doc)
+            new = bisect_right(self.keys, key)
+            if self.limit and new >= self.limit:
+                # Past the end of the window
+                new = None
+                self.complete = False
+            elif new == len(self.docs) and not self.complete:
+                # Unknown whether documents outside the window come first
+                new = None
+            else:
+                self.keys.insert(new, key)
+                self.docs.insert(new, doc)
+                self.ids.add(_id)
+
+        if old is not None and new is not None:
+            self.fanout.push(None, {'op': 'move', 'from': old, 'to': new,
+                                    'doc': doc})
+        elif old is not None:
+            self.fanout.push(None, {'op': 'remove', 'index': old})
+        elif new is not None:
+            self.fanout.push(None, {'op': 'insert', 'index': new,
+                                    'doc': doc})
+
+        if self.limit and len(self.docs) > self.limit:
+            # Evict past the end of the window
+            self.keys.pop()
+            self.ids.remove(self.docs.pop()['_id'])
+            self.complete = False
+            self.fanout.push(None, {'op': 'remove', 'index': self.limit})
+        elif old is not None and new is None and not self.complete:
+            self.refill()
+
+    def refill(self):
+        missing = self.limit - len(self.docs)
+        docs = self.window(skip=len(self.docs), limit=missing)
+        self.complete = len(docs) < missing
+
+        for doc in docs:
+            if doc['_id'] in self.ids:
+                continue
+            self.keys.append(self.sort_key(doc))
+            self.docs.append(doc)
+            self.ids.add(doc['_id'])
+            self.fanout.push(None, {'op': 'insert',
+                                    'index': len(self.docs) - 1,
+                                    'doc': doc})
+
+    def send(self, changes):
+        response = json.dumps({
+            'response': 'subscribe',
+            'query': self.query_key,
+            'collection': self.collection,
+            'changes': changes
+        })
+        for request in self.recipients():
+            request.send(response)
+
+
+class AggregateGroup(object):
+    def __init__(self, value, ordered=()):
+        self.value = value
+        self.ordered = ordered
+        self.count = 0
+        self.sums = {}
+        self.counts = {}
+        self.values = {}
+
+    def add(self, values, sign):
+        self.count += sign
+        for name, value in values.items():
+            if value is None:
+                continue
+
+            if isinstance(value, Number) and not isinstance(value, bool):
+                self.sums[name] = self.sums.get(name, 0) + sign * value
+                self.counts[name] = self.counts.get(name, 0) + sign
+
+            if name not in self.ordered:
+                continue
+
+            # Keep every value ordered so min/max survive removals
+            ordered = self.values.setdefault(name, [])
+            key = value_key(value)
+            if sign > 0:
+                insort(ordered, key)
+                continue
+
+            i = bisect_left(ordered, key)
+            if i < len(ordered) and not compare(ordered[i].obj, value):
+                del ordered[i]
+
+    def row(self, spec):
+        row = {'_id': self.value, 'count': self.count}
+        for name in spec.get('sum') or []:
+            row.setdefault('sum', {})[name] = self.sums.get(name, 0)
+        for name in spec.get('avg') or []:
+            count = self.counts.get(name)
+            row.setdefault('avg', {})[name] = \
+                self.sums[name] / float(count) if count else None
+        for name in spec.get('min') or []:
+            ordered = self.values.get(name)
+            row.setdefault('min', {})[name] = \
+                ordered[0].obj if ordered else None
+        for name in spec.get('max') or []:
+            ordered = self.values.get(name)
+            row.setdefault('max', {})[name] = \
+                ordered[-1].obj if ordered else None
+        return row
+
+
+class AggregateSubscription(LiveSubscription):
+    """Live aggregation over a query, e.g. `{'group': 'country', 'sum':
+    ['amount'], 'max': ['amount']}`. Computed once from a snapshot and then
+    updated from each op, sending only the group rows that changed."""
+
+    def __init__(self, store, collection, query_key, query, policy=None,
+                 aggregate=None):
+        super(AggregateSubscription, self).__init__(
+            store, collection, query_key, query, policy)
+        self.spec = aggregate or {}
+        self.group = self.spec.get('group')
+        self.fields = set()
+        self.ordered = set()
+        for accumulator in ('sum', 'avg', 'min', 'max'):
+            self.fields.update(self.spec.get(accumulator) or [])
+        for accumulator in ('min', 'max'):
+            self.ordered.update(self.spec.get(accumulator) or [])
+        self.groups = {}
+
+        # Contribution of each document, so ops can be applied idempotently
+        self.docs = {}
+
+    def project(self, doc):
+        return {name: field(doc, name) for name in self.fields}
+
+    def apply(self, _id, doc):
+        """Replace the contribution of a document, returning the keys of
+        the groups that changed"""
+        changed = []
+        if _id in self.docs:
+            key, values = self.docs.pop(_id)
+            self.groups[key].add(values, -1)
+            changed.append(key)
+
+        if doc is not None:
+            value = field(doc, self.group) if self.group else None
+            key = json.dumps(value)
+            if key not in self.groups:
+                self.groups[key] = AggregateGroup(value, self.ordered)
+            self.docs[_id] = key, self.project(doc)
+            self.groups[key].add(self.docs[_id][1], 1)
+            changed.append(key)
+        return changed
+
+    def load(self):
+        fields = list(self.fields) + ([self.group] if self.group else [])
+        cursor = self.find(fields=fields or ['_id'])
+        for doc in defer(cursor.to_list):
+            self.apply(doc['_id'], doc)
+
+    def snapshot(self):
+        return self.response([g.row(self.spec) for g in self.groups.values()])
+
+    def publish(self, ops):
+        doc = ops['updated'] if ops['op'] == 'update' else ops['doc']
+        if ops['op'] == 'remove' or not match(self.query, doc):
+            doc = None
+
+        for key in self.apply(ops['doc']['_id'], doc):
+            group = self.groups[key]
+            if group.count > 0:
+                self.fanout.push(key, group.row(self.spec))
+            else:
+                del self.groups[key]
+                self.fanout.push(key, {'_id': group.value, '$removed': True})
+
+    def send(self, rows):
+        response = json.dumps({
+            'response': 'subscribe',
+            'query': self.query_key,
+            'collection': self.collection,
+            'result': [r for r in rows if not r.get('$removed')],
+            'removed': [r['_id'] for r in rows if r.get('$removed')]
+        })
+        for request in self.recipients():
+            request.send(response)
+
+
 class Collection(object):
-    def __init__(self, store, name):
+    def __init__(self, store, name, **settings):
         self.store = store
         self.name = name
+        self.settings = settings
+
+    def options(self, **settings):
+        """This collection with a write concern or read preference
+        overriding the collection policy, e.g.
+        `model.telemetry.options(w=0).insert(...)` or
+        `model.articles.options(read_preference='nearest').find()`. Sub
+        collections are reached as attributes, except those named
+        `options`, `read_options` or `write_concern`, which need the full
+        name, e.g. `model['articles.options']`."""
+        return type(self)(self.store, self.name,
+                          **dict(self.settings, **settings))
+
+    def read_options(self):
+        preference = self.settings.get('read_preference')
+        if preference is not None:
+            return {'read_preference': parse_read_preference(preference)}
+        return self.store.read_options(self.name)
+
+    def write_concern(self, opslog=False):
+        concern = dict(self.store.default_concern)
+        concern.update(self.store.write_concerns.get(self.name, {}))
+        concern.update(self.settings)
+        concern.pop('read_preference', None)
+
+        opslog_concern = {}
+        for k in list(concern):
+            if k.startswith('opslog_'):
+                opslog_concern[k[len('opslog_'):]] = concern.pop(k)
+        if opslog:
+            concern.update(opslog_concern)
+        return concern
 
     def insert(self, **doc):
-        defer(self.store.db[self.name].insert, doc)
+        write(self.store.db[self.name].insert, doc, **self.write_concern())
         opslog = self.store.opslog(self.name)
-        defer(opslog.insert, {'op': 'insert', 'doc': doc}, manipulate=False)
+        write(opslog.insert, {'op': 'insert', 'doc': doc}, manipulate=False,
+              **self.write_concern(opslog=True))
 
     def update(self, _id=None, query=None, **ops):
+        """Update the matching documents, returning their new versions.
+        The documents are modified with findAndModify, a command that is
+        always acknowledged and ignores the write concern, so only the
+        opslog write follows it."""
         if not ops:
             return
         query = query or _id and {'_id': ObjectId(_id)}
@@ -147,35 +711,229 @@ class Collection(object):
             updated[d['_id']] = res
 
         opslog = self.store.opslog(self.name)
-        defer(opslog.insert, [
+        write(opslog.insert, [
             {'op': 'update', 'doc': d, 'updated': updated[d['_id']]}
             for d in docs if updated[d['_id']]
-        ], manipulate=False)
+        ], manipulate=False, **self.write_concern(opslog=True))
+        return [updated[d['_id']] for d in docs if updated[d['_id']]]
 
     def remove(self, **query):
-        docs = self.find(query)
-        res = defer(self.store.db[self.name].remove, query)
+        # Read from the primary, so the opslog has every removed document
+        docs = defer(self.store.db[self.name].find(query).to_list)
+        res = write(self.store.db[self.name].remove, query,
+                    **self.write_concern())
         opslog = self.store.opslog(self.name)
-        defer(opslog.insert, [{'op': 'remove', 'doc': d} for d in docs])
+        write(opslog.insert, [{'op': 'remove', 'doc': d} for d in docs],
+              **self.write_concern(opslog=True))
         return res
 
     def find(self, **query):
-        return defer(self.store.db[self.name].find(query).to_list)
+        return defer(self.store.db[self.name].find(
+            query, **self.read_options()).to_list)
 
     def __getattr__(self, name):
-        return Collection(self.store, '{0}.{1}'.format(self.name, name))
+        return Collection(self.store, '{0}.{1}'.format(self.name, name),
+                          **self.settings)
 
     def __len__(self):
-        return defer(self.store.db[self.name].count)
+        return defer(self.store.db[self.name].find(
+            **self.read_options()).count)
 
     def __nonzero__(self):
         return bool(len(self))
 
 
+class AsyncStore(object):
+    """Awaitable interface to a store for use from coroutines, without the
+    greenlet bridge, e.g. `docs = yield model.aio.users.find(name='x')`"""
+
+    def __init__(self, store):
+        self.store = store
+
+    @gen.coroutine
+    def opslog(self, collection):
+        collection_opslog = '{0}.opslog'.format(collection)
+        try:
+            yield future(self.store.db.create_collection, collection_opslog,
+                         capped=True, size=Store.OPSLOG_SIZE)
+
+            # Prime opslog as tailable cursors die on empty collections
+            yield future(self.store.db[collection_opslog].insert, {})
+        except CollectionInvalid:
+            pass
+
+        raise gen.Return(self.store.db[collection_opslog])
+
+    @gen.coroutine
+    def tail(self, collection, **query):
+        """Tail the opslog of a collection from now on, returning an
+        asynchronous iterator over the ops matching `query`"""
+        query = {'doc.{0}'.format(k): v for k, v in query.items()}
+        query['_id'] = {'$gt': ObjectId.from_datetime(datetime.utcnow())}
+        opslog = yield self.opslog(collection)
+        raise gen.Return(Tail(
+            opslog.find(query, tailable=True, await_data=True)))
+
+    def __getattr__(self, name):
+        return self[name]
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.store, name)
+
+
+class AsyncCollection(Collection):
+    @gen.coroutine
+    def insert(self, **doc):
+        yield write_future(self.store.db[self.name].insert, doc,
+                           **self.write_concern())
+        opslog = yield self.store.aio.opslog(self.name)
+        yield write_future(opslog.insert, {'op': 'insert', 'doc': doc},
+                           manipulate=False,
+                           **self.write_concern(opslog=True))
+
+    @gen.coroutine
+    def update(self, _id=None, query=None, **ops):
+        if not ops:
+            return
+        query = query or _id and {'_id': ObjectId(_id)}
+        docs = yield future(self.store.db[self.name].find(query).to_list)
+        updated = {}
+        for d in docs:
+            res = yield future(self.store.db[self.name].find_and_modify,
+                               query, ops, new=True)
+            updated[d['_id']] = res
+
+        opslog = yield self.store.aio.opslog(self.name)
+        yield write_future(opslog.insert, [
+            {'op': 'update', 'doc': d, 'updated': updated[d['_id']]}
+            for d in docs if updated[d['_id']]
+        ], manipulate=False, **self.write_concern(opslog=True))
+        raise gen.Return([updated[d['_id']] for d in docs
+                          if updated[d['_id']]])
+
+    @gen.coroutine
+    def remove(self, **query):
+        docs = yield future(self.store.db[self.name].find(query).to_list)
+        res = yield write_future(self.store.db[self.name].remove, query,
+                                 **self.write_concern())
+        opslog = yield self.store.aio.opslog(self.name)
+        yield write_future(opslog.insert,
+                           [{'op': 'remove', 'doc': d} for d in docs],
+                           **self.write_concern(opslog=True))
+        raise gen.Return(res)
+
+    def find(self, **query):
+        return future(self.store.db[self.name].find(
+            query, **self.read_options()).to_list)
+
+    def count(self):
+        return future(self.store.db[self.name].find(
+            **self.read_options()).count)
+
+    def __getattr__(self, name):
+        return AsyncCollection(self.store, '{0}.{1}'.format(self.name, name),
+                               **self.settings)
+
+
+class Tail(object):
+    """Asynchronous iterator over a tailable cursor. Each iteration
+    resolves to the next document; `close()` ends the iteration."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.items = deque()
+        self.waiter = None
+        self.closed = False
+        cursor.tail(self._callback)
+
+    def _callback(self, result, error):
+        if self.closed:
+            return False
+
+        if self.waiter:
+            waiter, self.waiter = self.waiter, None
+            resolve(waiter, result, error)
+        else:
+            self.items.append((result, error))
+
+    def next(self):
+        f = Future()
+        if self.items:
+            resolve(f, *self.items.popleft())
+        elif self.closed:
+            f.set_exception(StopAsyncIteration())
+        else:
+            self.waiter = f
+        return f
+
+    def close(self):
+        self.closed = True
+        self.cursor.close()
+        if self.waiter:
+            waiter, self.waiter = self.waiter, None
+            waiter.set_exception(StopAsyncIteration())
+
+    def __aiter__(self):
+        return self
+
+    __anext__ = next
+
+
+class MeteredPool(MotorPool):
+    """Motor pool recording connection checkouts, connections in use and
+    the time spent waiting for a connection"""
+
+    pools = WeakSet()
+
+    def __init__(self, *args, **kwargs):
+        MotorPool.__init__(self, *args, **kwargs)
+        MeteredPool.pools.add(self)
+        metrics.gauge('pool.in_use', MeteredPool.in_use)
+
+    @staticmethod
+    def in_use():
+        # Open sockets not idle in a pool. Derived from the pools' own
+        # counts, as failed sockets are discarded without being returned.
+        return sum(max(p.motor_sock_counter.count() - len(p.sockets), 0)
+                   for p in list(MeteredPool.pools))
+
+    def get_socket(self, *args, **kwargs):
+        start = time.time()
+        try:
+            sock_info = MotorPool.get_socket(self, *args, **kwargs)
+        finally:
+            metrics.timer('pool.wait').observe(time.time() - start)
+
+        metrics.counter('pool.checkouts').inc()
+        return sock_info
+
+
+class MeteredClientMixin(object):
+    def _delegate_init_args(self):
+        args, kwargs = super(MeteredClientMixin, self)._delegate_init_args()
+        pool_class = kwargs['_pool_class']
+        kwargs['_pool_class'] = partial(
+            MeteredPool, *pool_class.args, **pool_class.keywords)
+        return args, kwargs
+
+
+class MeteredMotorClient(MeteredClientMixin, MotorClient):
+    pass
+
+
+class MeteredMotorReplicaSetClient(MeteredClientMixin,
+                                   MotorReplicaSetClient):
+    pass
+
+
 class Model(object):
     pass
 
 
+class Timeout(Exception):
+    pass
+
+
 def context():
     gr = greenlet.getcurrent()
     main = greenlet.getcurrent().parent
@@ -183,17 +941,58 @@ def context():
     return gr, main
 
 
+@contextmanager
+def deadline(timeout):
+    """Bound every `defer` and `tail` call made by the current greenlet to
+    `timeout` seconds from now. Nested deadlines can only shorten it."""
+    if not timeout:
+        yield
+        return
+
+    gr = greenlet.getcurrent()
+    previous = getattr(gr, 'deadline', None)
+    gr.deadline = IOLoop.instance().time() + timeout
+    if previous is not None:
+        gr.deadline = min(gr.deadline, previous)
+    try:
+        yield
+    finally:
+        gr.deadline = previous
+
+
+def expire(gr, callback):
+    """Schedule `callback` to be called with a `Timeout` error at the
+    deadline of `gr`. The expired operation itself is not cancelled, it
+    runs to completion on its connection and its result is ignored."""
+    if getattr(gr, 'deadline', None) is None:
+        return None
+
+    def timeout():
+        metrics.counter('model.timeouts').inc()
+        callback(None, Timeout('Deadline exceeded'))
+
+    return IOLoop.instance().add_timeout(gr.deadline, timeout)
+
+
 def defer(f, *args, **kwargs):
     result = []
     gr, main = context()
 
     def callback(*r):
+        # Ignore late results of expired calls
+        if result:
+            return
         result[:] = r
         gr.switch(True)
 
-    f(callback=callback, *args, **kwargs)
-    while not main.switch():
-        pass
+    timeout = expire(gr, callback)
+    try:
+        f(callback=callback, *args, **kwargs)
+        while not main.switch():
+            pass
+    finally:
+        if timeout:
+            IOLoop.instance().remove_timeout(timeout)
 
     res, err = result
     if err:
@@ -201,22 +1000,127 @@ def defer(f, *args, **kwargs):
     return res
 
 
-def tail(f, *args, **kwargs):
-    result = []
-    gr, main = context()
+class Tailer(object):
+    """Iterator over the results of a callback style function that calls
+    back repeatedly, e.g. `cursor.tail`. Results arriving while the greenlet
+    is busy elsewhere are queued until the next iteration."""
+
+    def __init__(self, f, *args, **kwargs):
+        self.items = deque()
+        self.waiting = False
+        self.stopped = False
+        self.gr, self.main = context()
+        self.timeout = expire(self.gr, self.callback)
+        try:
+            f(callback=self.callback, *args, **kwargs)
+        except Exception:
+            self.stop()
+            raise
 
-    def iterator():
-        while True:
-            while not main.switch():
+    def callback(self, *r):
+        if self.stopped:
+            return False
+
+        self.items.append(r)
+        if self.waiting:
+            self.waiting = False
+            self.gr.switch(True)
+
+    def stop(self):
+        """Stop iterating, resuming a waiting greenlet from the IO loop"""
+        self.stopped = True
+        if self.timeout:
+            IOLoop.instance().remove_timeout(self.timeout)
+            self.timeout = None
+        if self.waiting:
+            self.waiting = False
+            IOLoop.instance().add_callback(self.gr.switch, True)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self.items:
+            if self.stopped:
+                self.stop()
+                raise StopIteration
+            self.waiting = True
+            while not self.main.switch():
                 pass
-            yield result
 
-    def callback(*r):
-        result[:] = r
-        gr.switch(True)
+        item = self.items.popleft()
+        if isinstance(item[1], Timeout):
+            self.stopped = True
+        return item
+
+    __next__ = next
+
+
+def tail(f, *args, **kwargs):
+    return Tailer(f, *args, **kwargs)
+
+
+def resolve(f, result, error):
+    if error:
+        f.set_exception(error)
+    else:
+        f.set_result(result)
+
+
+def future(f, *args, **kwargs):
+    """Call a callback style function, returning a future for its result"""
+    result = Future()
+    f(callback=partial(resolve, result), *args, **kwargs)
+    return result
+
+
+def parse_query_key(query_key):
+    """Query and subscription options from a client query key"""
+    query = json.loads(query_key)
+    if '$query' in query:
+        return query['$query'], query.get('$options') or {}
+    return query, {}
+
+
+def parse_read_preference(preference):
+    """Read preference from a mode name, e.g. 'secondaryPreferred' or
+    'SECONDARY_PREFERRED'"""
+    if preference is None or not isinstance(preference, string_types):
+        return preference
+    name = re.sub('([a-z])([A-Z])', r'\1_\2', preference).upper()
+    return getattr(ReadPreference, name)
+
+
+def write(f, *args, **kwargs):
+    """Write with the given write concern. Unacknowledged (`w=0`) writes
+    are fire-and-forget and return None immediately."""
+    if kwargs.get('w') == 0:
+        f(*args, **kwargs)
+        return None
+    return defer(f, *args, **kwargs)
+
+
+def write_future(f, *args, **kwargs):
+    """Future returning counterpart of `write`"""
+    if kwargs.get('w') == 0:
+        f(*args, **kwargs)
+        result = Future()
+        result.set_result(None)
+        return result
+    return future(f, *args, **kwargs)
+
+
+def wait(f):
+    """Wait for a future from a child greenlet"""
+    if f.done():
+        return f.result()
 
-    f(callback=callback, *args, **kwargs)
-    return iterator()
+    # Resumed from the IO loop, as `add_done_callback` could call back
+    # before this greenlet has switched away
+    def done(callback):
+        IOLoop.instance().add_future(f, lambda f: callback(
+            None if f.exception() else f.result(), f.exception()))
+    return defer(done)
 
 
 model = Store()
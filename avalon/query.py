@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Evaluation of Mongo queries and sorts against documents
+"""
+
+from functools import cmp_to_key
+
+_missing = object()
+
+
+def field(doc, name, default=None):
+    for part in name.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return default
+        doc = doc[part]
+    return doc
+
+
+def compare(a, b):
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        # Order mixed types consistently, None first
+        if a is None or b is None:
+            return (a is not None) - (b is not None)
+        a, b = type(a).__name__, type(b).__name__
+        return (a > b) - (a < b)
+
+
+def _match_value(value, condition):
+    if not isinstance(condition, dict) or not any(
+            k.startswith('$') for k in condition):
+        if isinstance(value, list) and not isinstance(condition, list):
+            return condition in value
+        return value == condition
+
+    for op, operand in condition.items():
+        if op == '$exists':
+            if (value is not _missing) != bool(operand):
+                return False
+            continue
+
+        if value is _missing:
+            value = None
+
+        if op == '$ne':
+            if value == operand:
+                return False
+        elif op == '$in':
+            if value not in operand:
+                return False
+        elif op == '$nin':
+            if value in operand:
+                return False
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            if value is None:
+                return False
+            c = compare(value, operand)
+            if ((op == '$gt' and c <= 0) or (op == '$gte' and c < 0) or
+                    (op == '$lt' and c >= 0) or (op == '$lte' and c > 0)):
+                return False
+        else:
+            # Unsupported operators are assumed to match, leaving the
+            # final say to the database
+            continue
+    return True
+
+
+def match(query, doc):
+    """Whether `doc` matches a Mongo `query`, for the subset of operators
+    used by live queries"""
+    if doc is None:
+        return False
+
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(match(q, doc) for q in condition):
+                return False
+        elif key == '$or':
+            if not any(match(q, doc) for q in condition):
+                return False
+        elif key == '$nor':
+            if any(match(q, doc) for q in condition):
+                return False
+        elif not _match_value(field(doc, key, _missing), condition):
+            return False
+    return True
+
+
+value_key = cmp_to_key(compare)
+
+
+def sort_key(sort):
+    """Key function for a Mongo sort spec, e.g. `[['score', -1]]`. Ties
+    are broken by `_id` so every document has a stable position."""
+    sort = list(sort or []) + [['_id', 1]]
+
+    def cmp(a, b):
+        for name, direction in sort:
+            c = compare(field(a, name), field(b, name))
+            if c:
+                return c * (1 if direction >= 0 else -1)
+        return 0
+
+    return cmp_to_key(cmp)
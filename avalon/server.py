@@ -4,34 +4,47 @@
 # Licence:      See LICENSE
 #==============================================================================
 
+import gzip
+import hashlib
+import io
 import logging
 import mimetypes
 import os
+import re
 import sys
 
-from bottle import get, default_app, static_file
+from bottle import get, abort, default_app, request, response, static_file
+from collections import OrderedDict
 from bson import json_util as json
 from greenlet import greenlet as Greenlet
-from six import StringIO
+from six import StringIO, text_type
 from lxml import html
 from lxml.html import builder as E
 from sockjs.tornado import router as _router, SockJSRouter
 from sockjs.tornado import SockJSConnection
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.escape import xhtml_unescape as unescape
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 from tornado.web import Application, FallbackHandler
 from tornado.wsgi import WSGIContainer
 
-from . import build, client, compiler, _log
-from .model import model
+from . import build, client, compiler, metrics, _log
+from .compiler.minify import minify
+from .model import model, deadline, wait, Timeout
 
 _routes = []
 _root_path = os.path.dirname(__file__)
 _view_path = 'views'
 _controller_path = 'controllers'
 _cdn = True
+_minify = False
+_split_scripts = False
+_scripts = None
+_compressed = {}
+_page = None
+_preload_marker = 'avalon-preload'
 _bundle_files = [
     (
         'SockJS',
@@ -65,6 +78,7 @@ _bundle_files = [
 ]
 _router.DEFAULT_SETTINGS['sockjs_url'] = '/bundle/sockjs-0.3.4.min.js'
 _methods = {}
+_preloads = []
 
 # Fix mimetypes
 mimetypes.add_type('image/png', '.png', True)
@@ -94,6 +108,7 @@ class ChannelConnection(SockJSConnection):
 
     def on_close(self):
         _log.info('CLOSE Channel {0} ({1})'.format(self.route, self.info.ip))
+        model.unsubscribe(self)
 
 
 def channel(route):
@@ -105,7 +120,9 @@ def channel(route):
     return _d
 
 
-def method(func_or_str=None):
+def method(func_or_str=None, timeout=None):
+    """Expose a server method, optionally with a default deadline in
+    seconds for each call"""
     if callable(func_or_str):
         f = func_or_str
         method_name = '{0}.{1}'.format(f.__module__, f.__name__)
@@ -115,6 +132,7 @@ def method(func_or_str=None):
 
         _methods[method_name] = f
         f.__server_method__ = method_name
+        f.__server_timeout__ = timeout
         return f
 
     def _d(f):
@@ -126,37 +144,140 @@ def method(func_or_str=None):
 
         _methods[method_name] = f
         f.__server_method__ = method_name
+        f.__server_timeout__ = timeout
         return f
     return _d
 
 
+def preload(collection, query=None, **options):
+    """Embed the result of a live query in the index page, so the page
+    renders before the channel is open, e.g.
+    `preload('articles', {'published': True}, sort=[['date', -1]], limit=20)`.
+    The client subscription with the same query and options picks up the
+    preloaded result and only receives changes made after it."""
+    _preloads.append((collection, query, options))
+
+
 @channel('/_avalon')
 def _server(request, message):
     message = json.loads(message)
+    if not isinstance(message, list):
+        _dispatch(request, message)
+        return
+
+    # Batched frame, start each message in order as if sent separately
+    for m in message:
+        Greenlet(_dispatch_logged).switch(request, m)
+
+
+def _dispatch_logged(request, message):
+    try:
+        _dispatch(request, message)
+    except Exception as e:
+        _log.exception(e)
+
+
+def _dispatch(request, message):
     method = message['method']
     params = message['params']
 
     if method == 'subscribe':
-        model.subscribe(request, *params)
+        try:
+            model.subscribe(request, *params)
+        except Exception as e:
+            _log.exception(e)
+            request.send(json.dumps({
+                'response': 'subscribe',
+                'collection': params[0],
+                'query': params[1],
+                'error': str(e) or type(e).__name__
+            }))
+
+    if method == 'unsubscribe':
+        model.unsubscribe(request, *params)
 
     if method == 'update':
-        model[params[0]].update(query=params[1], **params[2])
+        response = {'id': message.get('id'), 'response': 'update'}
+        try:
+            response['result'] = model[params[0]].update(
+                query=params[1], **params[2])
+        except Exception as e:
+            metrics.counter('update.errors').inc()
+            _log.exception(e)
+            response['error'] = str(e) or type(e).__name__
+
+        # Acknowledge updates applied optimistically by the client
+        if 'id' in message:
+            request.send(json.dumps(response))
 
     if method == 'rpc':
-        if not _methods.get(params[0]):
+        f = _methods.get(params[0])
+        if not f:
             raise ValueError('Method {0} not found'.format(params[0]))
-        request.send(json.dumps({
-            'id': message['id'],
-            'response': 'rpc',
-            'result': _methods[params[0]](*params[1:])
-        }))
+
+        response = {'id': message['id'], 'response': 'rpc'}
+        timeout = message.get('timeout') or f.__server_timeout__
+        try:
+            with deadline(timeout):
+                # Methods may be coroutines, e.g. using the `model.aio`
+                # interface
+                result = f(*params[1:])
+                if isinstance(result, Future):
+                    result = wait(result)
+            response['result'] = result
+        except Timeout:
+            metrics.counter('rpc.timeouts').inc()
+            _log.warning('RPC %s timed out after %ss', params[0], timeout)
+            response['error'] = 'timeout'
+
+        request.send(json.dumps(response))
 
 
 @get('/')
 def _index():
+    if _page is None:
+        return _render_index()
+
+    # Built page, with the preloaded subscriptions in place of the marker
+    preload = _preload_script()
+    if preload is None:
+        return _page
+    return _page.replace('<!--{0}-->'.format(_preload_marker),
+                         unescape(html.tostring(preload, encoding='utf-8')))
+
+
+def _view_files():
+    for dirpath, dirnames, filenames in os.walk(_view_path):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+def _styles():
+    style = StringIO()
+    for filename in _view_files():
+        handler = build.style_handler.get(os.path.splitext(filename)[-1])
+        if handler:
+            style.write(handler(filename))
+    return style.getvalue()
+
+
+def _preload_script():
+    if not _preloads or model.db_sync is None:
+        return None
+
+    preloads = [model.preload(*p) for p in _preloads]
+    return E.SCRIPT(
+        json.dumps(preloads).replace('</', '<\\/'),
+        id='avalon-preload',
+        type='application/json')
+
+
+def _render_index(stylesheet=None, static=False):
+    """Render the page from the views. With `stylesheet` the styles are
+    linked rather than inlined, and a `static` page has a marker in place
+    of the preloaded subscriptions, to be filled in per request."""
     # Gather, convert and process assets
     DOCTYPE = '<!DOCTYPE html>'
-    style = StringIO()
     head = E.HEAD()
     body = E.BODY()
     templates = []
@@ -189,64 +310,62 @@ def _index():
             node.remove(c)
         return
 
-    for dirpath, dirnames, filenames in os.walk(_view_path):
-        for filename in filenames:
-            ext = os.path.splitext(filename)[-1]
-            filename = os.path.join(dirpath, filename)
+    for filename in _view_files():
+        handler = build.template_handler.get(os.path.splitext(filename)[-1])
+        if not handler:
+            continue
+        contents = handler(filename)
 
-            handler = build.style_handler.get(ext)
-            if handler:
-                style.write(handler(filename))
-                continue
+        if not contents:
+            _log.warning('View is empty (%s)', filename)
+            continue
 
-            handler = build.template_handler.get(ext)
-            if not handler:
-                continue
-            contents = handler(filename)
-
-            if not contents:
-                _log.warning('View is empty (%s)', filename)
-                continue
-
-            try:
-                dom = html.fromstring('<head></head>' + contents)
-            except Exception as e:
-                _log.error('Parse error (%s) %s', filename, e)
+        try:
+            dom = html.fromstring('<head></head>' + contents)
+        except Exception as e:
+            _log.error('Parse error (%s) %s', filename, e)
+            continue
+
+        for e in dom.getchildren():
+            if e.tag == 'head':
+                head.extend(e.getchildren())
+            elif e.tag == 'body':
+                visit(e, filename)
+                body.text = (body.text or '') + (e.text or '')
+                body.extend(e.getchildren())
+            elif e.tag == 'template':
+                visit(E.BODY(e), filename)
+            else:
+                _log.error('View is invalid (%s)', filename)
                 continue
 
-            for e in dom.getchildren():
-                if e.tag == 'head':
-                    head.extend(e.getchildren())
-                elif e.tag == 'body':
-                    visit(e, filename)
-                    body.text = (body.text or '') + (e.text or '')
-                    body.extend(e.getchildren())
-                elif e.tag == 'template':
-                    visit(E.BODY(e), filename)
-                else:
-                    _log.error('View is invalid (%s)', filename)
-                    continue
-
-            s = 'angulate.registerTemplate("{0}", "{1}");'
-            templates.append(
-                E.SCRIPT(
-                    '\n'.join([
-                        s.format(name, 'template-{0}'.format(name))
-                        for name in template_names
-                    ]),
-                    type='text/javascript'))
+        s = 'angulate.registerTemplate("{0}", "{1}");'
+        templates.append(
+            E.SCRIPT(
+                '\n'.join([
+                    s.format(name, 'template-{0}'.format(name))
+                    for name in template_names
+                ]),
+                type='text/javascript'))
 
     # Append styles
-    head.append(E.STYLE(style.getvalue()))
+    if stylesheet:
+        head.append(E.LINK(rel='stylesheet', href=stylesheet))
+    else:
+        head.append(E.STYLE(_styles()))
+
+    # Append preloaded subscriptions
+    if static:
+        body.append(html.HtmlComment(_preload_marker))
+    else:
+        preload = _preload_script()
+        if preload is not None:
+            body.append(preload)
 
     # Append compiled runtime and Javascript functions
     body.extend([
-        E.SCRIPT(
-            compiler.runtime(),
-            type='text/javascript'),
-        E.SCRIPT(
-            '\n'.join(f for f in client.compiled()),
-            type='text/javascript')
+        E.SCRIPT(src='_avalon/{0}'.format(name), type='text/javascript')
+        for name in _compile_scripts()
     ])
 
     # Append bundle
@@ -295,6 +414,38 @@ def _index():
                                   encoding='utf-8'))
 
 
+@get('/_avalon/metrics')
+def _metrics():
+    return metrics.snapshot()
+
+
+@get('/_avalon/<filename:re:[\w.-]+\.(?:js|css)>')
+def _script(filename):
+    scripts = _compile_scripts()
+    if filename not in scripts:
+        abort(404, 'Script not found')
+
+    # Named by a hash of their contents, so never change
+    etag = '"{0}"'.format(filename)
+    response.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+    response.set_header('ETag', etag)
+    if filename.endswith('.css'):
+        response.content_type = 'text/css; charset=utf-8'
+    else:
+        response.content_type = 'application/javascript; charset=utf-8'
+    if request.get_header('If-None-Match') == etag:
+        response.status = 304
+        return ''
+
+    compressed = _compressed.get(filename)
+    if compressed is not None:
+        response.set_header('Vary', 'Accept-Encoding')
+        if 'gzip' in request.get_header('Accept-Encoding', ''):
+            response.set_header('Content-Encoding', 'gzip')
+            return compressed
+    return scripts[filename]
+
+
 @get('/bundle/<filename:re:(?!\.).+>')
 def _bundle(filename):
     return static_file(filename, root=os.path.join(_root_path, 'bundle'))
@@ -305,13 +456,171 @@ def _static(filename):
     return static_file(filename, root=_view_path)
 
 
+def _import_controllers():
+    module_path = os.path.join(_controller_path, '..')
+    if module_path not in sys.path:
+        sys.path.append(module_path)
+
+    for dirpath, dirnames, filenames in os.walk(_controller_path):
+        for f in filenames:
+            module, ext = os.path.splitext(f)
+            if ext != '.py':
+                continue
+            Greenlet(__import__).switch('{0}.{1}'.format(dirpath, module))
+
+
+def _compile_scripts():
+    """Compiled runtime and client functions as scripts named by a hash of
+    their contents, in load order. The runtime is reduced to the
+    definitions used by the client functions and avalon's bundle files.
+    With `_split_scripts` each scope gets a script of its own, so changing
+    one scope leaves the other scripts cached."""
+    global _scripts
+    if _scripts is None:
+        groups = OrderedDict([('app', [])])
+        for f, code in zip(client._functions, client.compiled()):
+            if _split_scripts and isinstance(f, client.ScopeType):
+                name = 'scope.{0}'.format(re.sub(r'[^\w-]', '_', f.name))
+            else:
+                name = 'app'
+            groups.setdefault(name, []).append(code)
+
+        functions = [(name, '\n'.join(code)) for name, code in groups.items()]
+        roots = [code for name, code in functions] + [
+            build.contents(os.path.join(_root_path, 'bundle', b[1]))
+            for b in _bundle_files if len(b) == 2
+        ]
+        if _minify:
+            functions = [(name, minify(code)) for name, code in functions]
+        runtime = compiler.runtime(roots, minified=_minify)
+
+        _scripts = OrderedDict()
+        for name, code in [('runtime', runtime)] + functions:
+            _scripts[_fingerprint(name, '.js', code)] = code
+    return _scripts
+
+
+def _encode(data):
+    return data.encode('utf-8') if isinstance(data, text_type) else data
+
+
+def _fingerprint(name, ext, data):
+    digest = hashlib.sha1(_encode(data)).hexdigest()
+    return '{0}.{1}{2}'.format(name, digest[:12], ext)
+
+
+def _gzip(data):
+    # No timestamp, so a build of the same sources is byte for byte the same
+    buf = io.BytesIO()
+    f = gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0)
+    f.write(_encode(data))
+    f.close()
+    return buf.getvalue()
+
+
+def _load_dist(path):
+    """Serve the page and scripts of a build instead of compiling"""
+    global _page, _scripts
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.loads(f.read())
+
+    def read(filename):
+        with io.open(os.path.join(path, filename), 'rb') as f:
+            return f.read()
+
+    _page = read(manifest['index']).decode('utf-8')
+    _scripts = OrderedDict()
+    for filename in manifest['scripts'] + [manifest['stylesheet']]:
+        name = os.path.basename(filename)
+        _scripts[name] = read(filename).decode('utf-8')
+        if filename + '.gz' in manifest['compressed']:
+            _compressed[name] = read(filename + '.gz')
+
+
+def _precompile(workers):
+    compiler.compile_all(compiler.runtime_modules() + client._functions,
+                         workers)
+
+
+def compile(controller_path=None, verbose=False, workers=1):
+    """Compile the runtime and every client function of the project,
+    filling the compile cache"""
+    global _controller_path
+    _controller_path = controller_path or _controller_path
+
+    if verbose:
+        _log.setLevel(logging.INFO)
+
+    _import_controllers()
+    _precompile(workers)
+    return [compiler.runtime()] + client.compiled()
+
+
+def build_static(output='dist', view_path=None, controller_path=None,
+                 cdn=True, minify=False, workers=1, split_scripts=False,
+                 verbose=False):
+    """Build the page, styles and compiled scripts into `output`, with
+    names fingerprinted by their contents, gzipped variants and a
+    `manifest.json` for `serve(dist=output)`. Files of earlier builds are
+    left in place, for clients still running them."""
+    global _view_path, _controller_path, _cdn, _minify, _split_scripts
+    _view_path = view_path or _view_path
+    _controller_path = controller_path or _controller_path
+    _cdn = cdn
+    _minify = minify
+    _split_scripts = split_scripts
+
+    if verbose:
+        _log.setLevel(logging.INFO)
+
+    _import_controllers()
+    _precompile(workers)
+
+    files = OrderedDict()
+    scripts = ['_avalon/{0}'.format(n) for n in _compile_scripts()]
+    files.update(zip(scripts, _compile_scripts().values()))
+
+    style = _styles()
+    stylesheet = '_avalon/{0}'.format(_fingerprint('style', '.css', style))
+    files[stylesheet] = style
+
+    page = _render_index(stylesheet=stylesheet, static=True)
+    index = _fingerprint('index', '.html', page)
+    files[index] = page
+
+    compressed = []
+    for filename, data in list(files.items()):
+        compressed.append(filename + '.gz')
+        files[filename + '.gz'] = _gzip(data)
+
+    for filename, data in files.items():
+        filename = os.path.join(output, filename)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with io.open(filename, 'wb') as f:
+            f.write(_encode(data))
+
+    manifest = OrderedDict([
+        ('index', index),
+        ('stylesheet', stylesheet),
+        ('scripts', scripts),
+        ('compressed', compressed)
+    ])
+    with io.open(os.path.join(output, 'manifest.json'), 'wb') as f:
+        f.write(_encode(json.dumps(manifest, indent=2)))
+    return manifest
+
+
 def serve(db=None, mount_app=None, port=8080, verbose=False,
-          view_path=None, controller_path=None, cdn=True):
+          view_path=None, controller_path=None, cdn=True, db_options=None,
+          minify=False, workers=1, split_scripts=False, dist=None):
 
-    global _view_path, _controller_path, _cdn
+    global _view_path, _controller_path, _cdn, _minify, _split_scripts
     _view_path = view_path or _view_path
     _controller_path = controller_path or _controller_path
     _cdn = cdn
+    _minify = minify
+    _split_scripts = split_scripts
 
     if verbose:
         _log.setLevel(logging.INFO)
@@ -325,24 +634,21 @@ def serve(db=None, mount_app=None, port=8080, verbose=False,
 
     # Connect to db
     if db:
-        model.connect(db)
+        model.connect(db, **(db_options or {}))
 
     wsgi_app = WSGIContainer(default_app())
     app = Application(r + [
         ('.*', FallbackHandler, {'fallback': wsgi_app})
     ])
 
-    # Import controllers
-    module_path = os.path.join(_controller_path, '..')
-    if module_path not in sys.path:
-        sys.path.append(module_path)
+    _import_controllers()
 
-    for dirpath, dirnames, filenames in os.walk(_controller_path):
-        for f in filenames:
-            module, ext = os.path.splitext(f)
-            if ext != '.py':
-                continue
-            Greenlet(__import__).switch('{0}.{1}'.format(dirpath, module))
+    # Compile up front when a process pool can share the work, otherwise
+    # the first request compiles. A build has nothing left to compile.
+    if dist:
+        _load_dist(dist)
+    elif workers > 1:
+        _precompile(workers)
 
     server = HTTPServer(app)
     server.listen(port)
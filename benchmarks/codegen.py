@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Generated code size, and execution speed under node when available, of
+the state machine and straight-line function code generation.
+
+Usage: python benchmarks/codegen.py [iterations]
+"""
+
+from __future__ import print_function
+
+import ast
+import inspect
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from distutils.spawn import find_executable
+
+from avalon import client
+from avalon.compiler import builtins, exceptions, types
+from avalon.compiler.compiler import JSCompiler
+
+ITERATIONS = 20
+
+RUNNER = '''
+var iterations = {iterations};
+var start = Date.now();
+for (var i = 0; i < iterations; i++) fib(20);
+var fibTime = (Date.now() - start) / iterations;
+start = Date.now();
+for (var i = 0; i < iterations; i++) loops(10000);
+var loopsTime = (Date.now() - start) / iterations;
+console.log(JSON.stringify([fibTime, loopsTime]));
+'''
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def loops(n):
+    total = 0
+    for i in range(n):
+        j = 0
+        while j < 10:
+            if (i + j) % 3 == 0:
+                total += j
+            j += 1
+    return total
+
+
+def compile_all(straight_line):
+    def js(obj):
+        source = inspect.getsource(obj)
+        compiler = JSCompiler(obj, straight_line=straight_line)
+        return compiler.visit(ast.parse(source))
+
+    runtime = ''.join(js(m) for m in (builtins, types, exceptions))
+    functions = ''.join(js(f) for f in client._functions)
+    workload = js(fib) + js(loops)
+    return runtime, functions, workload
+
+
+def execute(node, code, iterations):
+    fd, path = tempfile.mkstemp(suffix='.js')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(code + RUNNER.format(iterations=iterations))
+        return json.loads(subprocess.check_output([node, path]).decode())
+    finally:
+        os.remove(path)
+
+
+def main(iterations):
+    node = find_executable('node') or find_executable('nodejs')
+
+    for name, straight_line in (('state machine', False),
+                                ('straight-line', True)):
+        runtime, functions, workload = compile_all(straight_line)
+        print('{0:>16}: runtime {1:7d} bytes, client functions {2:7d} bytes'
+              .format(name, len(runtime), len(functions)))
+
+        if node:
+            fib, loops = execute(node, runtime + workload, iterations)
+            print('{0:>16}  fib(20) {1:8.2f} ms, loops(10000) {2:8.2f} ms'
+                  .format('', fib, loops))
+
+    if not node:
+        print('node not found, execution speed not measured')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Compiler throughput over the runtime modules and the client functions.
+
+Usage: python benchmarks/compiler.py [rounds]
+"""
+
+from __future__ import print_function
+
+import ast
+import inspect
+import sys
+import time
+
+from avalon import client
+from avalon.compiler import builtins, exceptions, types
+from avalon.compiler.compiler import JSCompiler
+
+ROUNDS = 20
+
+
+def measure(obj, rounds):
+    source = inspect.getsource(obj)
+    nodes = sum(1 for _ in ast.walk(ast.parse(source)))
+
+    # Warm up, e.g. the lookup environment imports
+    JSCompiler(obj).visit(ast.parse(source))
+
+    elapsed = 0.0
+    for i in range(rounds):
+        # The compiler annotates the tree, so every round gets a fresh one
+        node = ast.parse(source)
+        start = time.time()
+        JSCompiler(obj).visit(node)
+        elapsed += time.time() - start
+    return nodes, elapsed / rounds
+
+
+def main(rounds):
+    targets = [(m.__name__, m) for m in (builtins, types, exceptions)]
+    targets += [('{0}.{1}'.format(f.__module__, f.__name__), f)
+                for f in client._functions]
+
+    total_nodes = total_elapsed = 0
+    for name, obj in targets:
+        nodes, elapsed = measure(obj, rounds)
+        total_nodes += nodes
+        total_elapsed += elapsed
+        print('{0:>32}: {1:6d} nodes {2:8.2f} ms {3:10.0f} nodes/s'.format(
+            name, nodes, elapsed * 1e3, nodes / elapsed))
+
+    print('{0:>32}: {1:6d} nodes {2:8.2f} ms {3:10.0f} nodes/s'.format(
+        'total', total_nodes, total_elapsed * 1e3,
+        total_nodes / total_elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else ROUNDS)
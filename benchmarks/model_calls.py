@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Per-call overhead of the greenlet `defer` bridge against the `model.aio`
+coroutine interface.
+
+Usage: python benchmarks/model_calls.py [mongodb://localhost/avalon_bench]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from greenlet import greenlet as Greenlet
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from avalon.model import model
+
+CALLS = 2000
+
+
+def greenlet_path():
+    done = Future()
+
+    def run():
+        collection = model.bench
+        start = time.time()
+        for i in range(CALLS):
+            len(collection)
+        done.set_result(time.time() - start)
+
+    Greenlet(run).switch()
+    return done
+
+
+@gen.coroutine
+def coroutine_path():
+    collection = model.aio.bench
+    start = time.time()
+    for i in range(CALLS):
+        yield collection.count()
+    raise gen.Return(time.time() - start)
+
+
+@gen.coroutine
+def main():
+    for name, path in [('greenlet', greenlet_path),
+                       ('coroutine', coroutine_path)]:
+        elapsed = yield path()
+        print('{0:>10}: {1:8.1f} us/call  {2:8.0f} calls/s'.format(
+            name, elapsed / CALLS * 1e6, CALLS / elapsed))
+
+
+if __name__ == '__main__':
+    model.connect(sys.argv[1] if len(sys.argv) > 1 else
+                  'mongodb://localhost/avalon_bench')
+    IOLoop.instance().run_sync(main)
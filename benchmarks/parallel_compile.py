@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Wall-clock time of compiling a generated app of client functions against
+the number of compiler processes, with the compile cache disabled.
+
+Usage: python benchmarks/parallel_compile.py [functions]
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from avalon.compiler import cache, compiler
+
+FUNCTIONS = 200
+
+TEMPLATE = '''
+def f{0}(items, n):
+    total = 0
+    for i in range(n):
+        if i % 3 == 0:
+            continue
+        total += i
+    found = [x * 2 for x in items if x > n]
+    while total > 100:
+        total -= n
+    return [total, found]
+'''
+
+
+def generate(path, functions):
+    with open(os.path.join(path, 'bench_app.py'), 'w') as f:
+        for i in range(functions):
+            f.write(TEMPLATE.format(i))
+    sys.path.insert(0, path)
+    import bench_app
+    return [getattr(bench_app, 'f{0}'.format(i)) for i in range(functions)]
+
+
+def measure(objs, workers):
+    for obj in objs:
+        obj.__js__ = None
+    start = time.time()
+    compiler.compile_all(objs, workers)
+    return time.time() - start
+
+
+def main(functions):
+    cache.path = None
+    path = tempfile.mkdtemp()
+    try:
+        objs = generate(path, functions)
+
+        # Warm up, e.g. the lookup environment imports
+        measure(objs[:1], 1)
+        counts = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+
+        baseline = None
+        for workers in counts:
+            elapsed = measure(objs, workers)
+            baseline = baseline or elapsed
+            print('{0:>3} workers: {1:8.2f} s {2:6.2f}x'.format(
+                workers, elapsed, baseline / elapsed))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else FUNCTIONS)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+# Copyright:    Hybrid Labs
+# Licence:      See LICENSE
+#==============================================================================
+
+"""
+Insert throughput of `Collection.insert` for each write concern setting.
+
+Usage: python benchmarks/write_concern.py [mongodb://localhost/avalon_bench]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from greenlet import greenlet as Greenlet
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from avalon.model import model
+
+INSERTS = 2000
+CONCERNS = [
+    ('w=1 j=1', {'w': 1, 'j': True}),
+    ('w=1 j=1 opslog w=0', {'w': 1, 'j': True, 'opslog_w': 0}),
+    ('w=1 j=0', {'w': 1, 'j': False}),
+    ('w=1 j=0 opslog w=0', {'w': 1, 'j': False, 'opslog_w': 0}),
+    ('w=0', {'w': 0}),
+]
+
+
+def run(concern):
+    done = Future()
+
+    def inserts():
+        collection = model.bench.options(**concern)
+        start = time.time()
+        for i in range(INSERTS):
+            collection.insert(i=i, payload='x' * 64)
+        done.set_result(time.time() - start)
+
+    Greenlet(inserts).switch()
+    return done
+
+
+@gen.coroutine
+def main():
+    for name, concern in CONCERNS:
+        elapsed = yield run(concern)
+        print('{0:>20}: {1:8.0f} inserts/s'.format(name, INSERTS / elapsed))
+
+
+if __name__ == '__main__':
+    model.connect(sys.argv[1] if len(sys.argv) > 1 else
+                  'mongodb://localhost/avalon_bench')
+    IOLoop.instance().run_sync(main)